@@ -2,29 +2,73 @@
 """
 This module updates the docker images of the docker-compose on the given path
 """
-from contextlib import contextmanager
 from email.mime.text import MIMEText
 from collections import defaultdict
+from bisect import bisect_left
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import http.client
 import smtplib
 import logging
 import argparse
 import re
 import os
 import sys
-import subprocess
+import asyncio
+import shlex
+import signal
 import socket
+import json
+import threading
+import time
+import urllib.parse
+import statistics
+import queue
+import hashlib
+import difflib
+import tempfile
+import fcntl
+import zlib
 import yaml
 import requests
 import packaging.version
+import packaging.specifiers
+
+# Use the C implementation of the YAML loader if libyaml is available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 class Updater:
 
     """Update a single docker-compose.yml."""
 
-    def __init__(self, path, dryrun):
+    def __init__(
+        self,
+        path,
+        dryrun,
+        running_state=None,
+        tag_cache=None,
+        scheduler=None,
+        parse_cache=None,
+        rollout_timeout=0,
+        compose_timeout=None,
+        keep_images=0,
+    ):  # pylint: disable=too-many-arguments
         self.path = path
         self.dryrun = dryrun
+        self.running_state = running_state
+        if tag_cache is None:
+            tag_cache = TagCache()
+        self.tag_cache = tag_cache
+        self.scheduler = scheduler
+        if parse_cache is None:
+            parse_cache = ParseCache()
+        self.parse_cache = parse_cache
+        self.rollout_timeout = rollout_timeout
+        self.compose_timeout = compose_timeout
+        self.steps = []
+        self.keep_images = keep_images
+        self.rolled_back = False
         # Read docker-compose.yml as list
         self.docker_compose_path = os.path.join(path, "docker-compose.yml")
         self.docker_compose_versions_path = os.path.join(
@@ -34,15 +78,96 @@ class Updater:
         self.docker_compose_versions = None
         self.services = {"auto_update": dict(), "manual_update": dict()}
         self.updated_services = defaultdict(dict)
+        self.drift = {}
+        self.built = False
 
     def run(self):
         """Run this class
         :returns: None
 
+        """
+        updates_found = self.resolve()
+        # Running containers of services without a new version that drifted
+        # are recreated with the pinned images. Services without a running
+        # container may have been stopped on purpose and are only reported.
+        reconcile = [
+            service_name
+            for service_name in self.services["auto_update"]
+            if self.drift.get(service_name, RunningState.not_running)
+            != RunningState.not_running
+            and service_name not in self.updated_services.get("auto_update", {})
+        ]
+        if not updates_found and not reconcile:
+            return
+
+        mail_text = "Updates in directory " + self.path + " on " + get_hostname() + "\n"
+        snapshot = self.take_snapshot()
+        for service_type in self.updated_services:
+            mail_text = mail_text + get_update_heading(service_type)
+
+            for service_name, service in self.updated_services[service_type].items():
+                mail_text = (
+                    mail_text
+                    + service_name
+                    + ":\n  Old: "
+                    + service.current_version
+                    + "\n  New: "
+                    + service.next_version
+                    + "\n"
+                )
+                if service_type == "auto_update" and not self.dryrun:
+                    if service.dockerfile_path:
+                        self.write_to_dockerfile(service)
+                        self.build()
+                    else:
+                        self.write_to_docker_compose(service_name, service)
+            if service_type == "auto_update" and not self.dryrun:
+                if self.built or not self.is_converged():
+                    self.up()
+                    mail_text = mail_text + self.rollout(snapshot)
+                    mail_text = mail_text + self.prune_images()
+                    mail_text = mail_text + self.get_step_report()
+                else:
+                    logging.info(
+                        "Containers in %s already run the pinned images, "
+                        + "skipping docker compose up",
+                        self.path,
+                    )
+        mail_text = mail_text + self.get_drift_report()
+        if reconcile and "auto_update" not in self.updated_services:
+            mail_text = (
+                mail_text
+                + "\nThe drifted services "
+                + ", ".join(reconcile)
+                + " where restarted with the pinned images.\n"
+            )
+            if not self.dryrun:
+                self.up(*reconcile)
+                mail_text = mail_text + self.get_step_report()
+        if self.dryrun:
+            logging.info("Dryrun, not sending email")
+            return
+        write_email(
+            mail_text,
+            "[Dockerupdate][" + get_hostname() + "] Service Update for " + self.path,
+        )
+
+    def resolve(self):
+        """Read the project and search for new versions of its services
+        :returns: True if new versions where found
+
         """
         self.read()
         if self.docker_compose_versions is None or self.docker_compose is None:
-            return
+            return False
+        self.drift = self.get_drift() or {}
+        for service_name, reason in self.drift.items():
+            logging.warning(
+                "Service %s in %s drifted from docker-compose.yml: %s",
+                service_name,
+                self.path,
+                reason,
+            )
         for service_type in self.services:
             for service_name, service in self.services[service_type].items():
                 # For manual updates check if auto_update already found a new
@@ -55,7 +180,23 @@ class Updater:
                         service_name
                     ].next_version
 
+                if self.scheduler is not None and not self.scheduler.is_due(
+                    service.image
+                ):
+                    logging.debug(
+                        "Image %s of service %s in %s is not due for a check",
+                        service.image,
+                        service_name,
+                        self.path,
+                    )
+                    continue
                 service.find_next_version()
+                if self.scheduler is not None:
+                    self.scheduler.record(
+                        service.image,
+                        self.tag_cache.get(service.image),
+                        self.get_priority(),
+                    )
                 if service.current_version == service.next_version:
                     logging.debug(
                         "No new version was found for service %s in %s",
@@ -72,42 +213,126 @@ class Updater:
 
         if not self.updated_services:
             logging.info("No changes for services in %s where found.", self.path)
-            return
+            return False
+        return True
 
-        mail_text = "Updates in directory " + self.path + " on " + get_hostname() + "\n"
+    def plan(self):
+        """Resolve the updates and compute the resulting file changes without
+        writing, building or restarting anything
+
+        :returns: dict with the planned changes or None if there are none
+
+        """
+        if not self.resolve():
+            return None
+        originals = {}
+        contents = {}
+        updates = {}
+        build = False
         for service_type in self.updated_services:
-            if service_type == "auto_update":
-                mail_text = mail_text + (
-                    "\nThe following Updates where found and automatically applied:\n\n"
-                )
-            else:
-                mail_text = (
-                    mail_text
-                    + "\nThe following Updates where found but where not applied as "
-                    + "they are configured for manual updates only:\n\n"
+            updates[service_type] = {}
+            for service_name, service in self.updated_services[service_type].items():
+                updates[service_type][service_name] = {
+                    "image": service.image,
+                    "old": service.current_version,
+                    "new": service.next_version,
+                    "pull_size": get_pull_size(
+                        self.tag_cache.get(service.image),
+                        service.next_version,
+                        service.platforms[0],
+                    ),
+                }
+                if service_type != "auto_update":
+                    continue
+                path = os.path.normpath(
+                    service.dockerfile_path or self.docker_compose_path
                 )
+                if path not in contents:
+                    with open(path, "r") as stream:
+                        originals[path] = stream.read()
+                    contents[path] = originals[path].splitlines(True)
+                if service.dockerfile_path:
+                    contents[path] = update_dockerfile_lines(contents[path], service)
+                    build = True
+                else:
+                    contents[path] = update_docker_compose_lines(
+                        contents[path], service_name, service
+                    )
+        auto_updates = updates.get("auto_update", {})
+        return {
+            "path": self.path,
+            "files": [
+                {
+                    "path": path,
+                    "sha256": get_text_hash(originals[path]),
+                    "content": "".join(lines),
+                    "diff": "".join(
+                        difflib.unified_diff(
+                            originals[path].splitlines(True), lines, path, path
+                        )
+                    ),
+                }
+                for path, lines in contents.items()
+            ],
+            "build": build,
+            "restart": sorted(auto_updates),
+            "pull_size": sum(
+                update["pull_size"] or 0 for update in auto_updates.values()
+            ),
+            "updates": updates,
+        }
+
+    def apply(self, plan):
+        """Apply the changes of a plan created by plan() without searching for
+        new versions again
+
+        :plan: Plan of this project
+        :returns: None
 
-            for service_name, service in self.updated_services[service_type].items():
+        """
+        snapshot = {"files": {}, "images": {}}
+        for entry in plan["files"]:
+            try:
+                with open(entry["path"], "r") as stream:
+                    snapshot["files"][entry["path"]] = stream.read()
+            except FileNotFoundError as error:
+                raise PlanError(f"{entry['path']} does not exist anymore") from error
+            if get_text_hash(snapshot["files"][entry["path"]]) != entry["sha256"]:
+                raise PlanError(f"{entry['path']} changed since the plan was created")
+        auto_updates = plan["updates"].get("auto_update", {})
+        for service_name, update in auto_updates.items():
+            snapshot["images"][service_name] = update["image"] + ":" + update["old"]
+        if self.dryrun:
+            for entry in plan["files"]:
+                logging.info("Dryrun, not applying\n%s", entry["diff"])
+            return
+
+        mail_text = "Updates in directory " + self.path + " on " + get_hostname() + "\n"
+        for service_type, updates in plan["updates"].items():
+            mail_text = mail_text + get_update_heading(service_type)
+            for service_name, update in updates.items():
                 mail_text = (
                     mail_text
                     + service_name
                     + ":\n  Old: "
-                    + service.current_version
+                    + update["old"]
                     + "\n  New: "
-                    + service.next_version
+                    + update["new"]
                     + "\n"
                 )
-                if service_type == "auto_update" and not self.dryrun:
-                    if service.dockerfile_path:
-                        self.write_to_dockerfile(service)
-                        self.build()
-                    else:
-                        self.write_to_docker_compose(service_name, service)
-            if service_type == "auto_update" and not self.dryrun:
-                self.up()
-        if self.dryrun:
-            logging.info("Dryrun, not sending email")
-            return
+        for entry in plan["files"]:
+            logging.info("Writing planned changes to %s", entry["path"])
+            with open(entry["path"], "w") as stream:
+                stream.write(entry["content"])
+        if auto_updates:
+            if plan["build"]:
+                self.build()
+            self.up(*plan["restart"])
+            mail_text = mail_text + self.rollout(snapshot)
+            mail_text = mail_text + self.prune_images(
+                {update["image"]: update["new"] for update in auto_updates.values()}
+            )
+            mail_text = mail_text + self.get_step_report()
         write_email(
             mail_text,
             "[Dockerupdate][" + get_hostname() + "] Service Update for " + self.path,
@@ -122,16 +347,13 @@ class Updater:
             logging.info("Dryrun, skipping docker compose build")
             return
 
-        with working_directory(self.path):
-            logging.info("Running docker-compose build")
-            try:
-                subprocess.run(["/usr/local/bin/docker compose", "build"], check=True)
-            except subprocess.CalledProcessError as error:
-                logging.error("Could not run docker compose build: %s", error)
-                error_mail(error)
+        self.built = True
+        self.compose("build")
 
-    def up(self):  # pylint: disable=invalid-name
+    def up(self, *services):  # pylint: disable=invalid-name
         """Start the new Docker containers
+
+        :services: Names of the services to start, all if none are given
         :returns: None
 
         """
@@ -139,15 +361,228 @@ class Updater:
             logging.info("Dryrun, skipping docker compose up")
             return
 
-        with working_directory(self.path):
-            logging.info("Running docker compose up -d")
-            try:
-                subprocess.run(
-                    ["/usr/local/bin/docker compose", "up", "-d"], check=True
-                )
-            except subprocess.CalledProcessError as error:
-                logging.error("Could not run docker compose up: %s", error)
-                error_mail(error)
+        self.compose("up", "-d", *services)
+
+    def compose(self, *args):
+        """Run a docker compose command in the project directory and add it to
+        the report
+
+        :args: arguments for docker compose
+        :returns: ComposeStep
+
+        """
+        logging.info("Running docker compose %s in %s", " ".join(args), self.path)
+        step = run_compose(args, self.path, self.compose_timeout)
+        self.steps.append(step)
+        if not step.succeeded:
+            text = (
+                "Could not run docker compose "
+                + " ".join(args)
+                + " in "
+                + self.path
+                + ": "
+                + step.get_error()
+                + "\n"
+                + "\n".join(step.output[-50:])
+            )
+            logging.error(text)
+            error_mail(text)
+        return step
+
+    def get_step_report(self):
+        """Report the docker compose commands run for this project with their
+        durations and output
+
+        :returns: Text for the update mail
+
+        """
+        if not self.steps:
+            return ""
+        text = "\nThe following docker compose commands where run:\n"
+        for step in self.steps:
+            text = (
+                text
+                + "\n"
+                + " ".join(step.argv)
+                + ": "
+                + f"{step.duration:.1f}s, "
+                + ("succeeded" if step.succeeded else step.get_error())
+                + "\n"
+            )
+            text = text + "".join("  " + line + "\n" for line in step.output)
+        return text
+
+    def take_snapshot(self):
+        """Save the docker-compose.yml, the Dockerfiles and the images of the
+        services that are updated automatically, to be able to roll back
+
+        :returns: dict with the file contents and the previous images
+
+        """
+        snapshot = {"files": {}, "images": {}}
+        auto_updates = self.updated_services.get("auto_update", {})
+        if self.dryrun or not auto_updates:
+            return snapshot
+        paths = [self.docker_compose_path]
+        for service_name, service in auto_updates.items():
+            snapshot["images"][service_name] = (
+                service.image + ":" + service.current_version
+            )
+            if service.dockerfile_path:
+                paths.append(service.dockerfile_path)
+        for path in paths:
+            with open(path, "r") as stream:
+                snapshot["files"][path] = stream.read()
+        return snapshot
+
+    def rollout(self, snapshot):
+        """Wait until the containers of the automatically updated services are
+        healthy and roll back to the snapshot if they are not
+
+        :snapshot: Snapshot taken before the update
+        :returns: Text for the update mail
+
+        """
+        if not self.rollout_timeout or not snapshot["images"]:
+            return ""
+        service_names = list(snapshot["images"])
+        engine = DockerEngine()
+        try:
+            failed = wait_for_health(
+                engine, self.path, service_names, self.rollout_timeout
+            )
+        except (OSError, http.client.HTTPException, DockerEngineError) as error:
+            logging.warning(
+                "Cannot check the health of the services in %s: %s", self.path, error
+            )
+            return ""
+        finally:
+            engine.close()
+        if not failed:
+            logging.info("Services %s in %s are healthy", service_names, self.path)
+            return ""
+
+        logging.error(
+            "Services in %s did not become healthy, rolling back: %s",
+            self.path,
+            failed,
+        )
+        self.rolled_back = True
+        for path, content in snapshot["files"].items():
+            with open(path, "w") as stream:
+                stream.write(content)
+        if self.built:
+            self.build()
+        self.up(*service_names)
+        text = (
+            "\nThe updated services did not become healthy within "
+            + str(self.rollout_timeout)
+            + " seconds and where rolled back:\n\n"
+        )
+        for service_name in service_names:
+            text = (
+                text
+                + service_name
+                + ":\n  State: "
+                + failed.get(service_name, "healthy")
+                + "\n  Rolled back to: "
+                + snapshot["images"][service_name]
+                + "\n"
+            )
+        return text
+
+    def prune_images(self, images=None):
+        """Remove superseded images of the automatically updated services,
+        keeping the newest keep_images previous versions for rollbacks
+
+        :images: dict of image and current version, defaults to the
+        automatically updated services
+        :returns: Text for the update mail
+
+        """
+        if not self.keep_images or self.rolled_back:
+            return ""
+        if images is None:
+            images = {
+                service.image: service.next_version
+                for service in self.updated_services.get("auto_update", {}).values()
+            }
+        engine = DockerEngine()
+        try:
+            removed = prune_images(engine, images, self.keep_images)
+        except (OSError, http.client.HTTPException, DockerEngineError) as error:
+            logging.warning("Cannot prune images for %s: %s", self.path, error)
+            return ""
+        finally:
+            engine.close()
+        if not removed:
+            return ""
+        return "\nThe following superseded images where removed:\n\n" + "".join(
+            "  " + reference + "\n" for reference in removed
+        )
+
+    def get_drift(self, pinned=None):
+        """Compare the running containers of the services managed in the
+        docker-compose-versions.yml with the images pinned in the
+        docker-compose.yml. Services that are built locally are only checked
+        for a running container.
+
+        :pinned: dict of service name and image overriding the pinned images
+        :returns: dict of service name and drift description, None if the
+        running state is unknown
+        """
+        # The services read through the parse cache keep their image
+        if self.running_state is None or not isinstance(self.docker_compose, dict):
+            return None
+
+        compose_services = self.docker_compose.get("services") or {}
+        drift = {}
+        for service_type in self.services:
+            for service_name in self.services[service_type]:
+                image = None
+                if isinstance(compose_services.get(service_name), dict):
+                    image = compose_services[service_name].get("image")
+                image = (pinned or {}).get(service_name, image)
+                reason = self.running_state.get_drift(self.path, service_name, image)
+                if reason is not None:
+                    drift[service_name] = reason
+        return drift
+
+    def get_drift_report(self):
+        """Report the services that drifted from the docker-compose.yml
+        :returns: Text for the update mail
+
+        """
+        if not self.drift:
+            return ""
+        text = "\nThe following services drifted from docker-compose.yml:\n\n"
+        for service_name, reason in sorted(self.drift.items()):
+            text = text + service_name + ":\n  " + reason + "\n"
+        return text
+
+    def get_priority(self):
+        """Get the priority given in the docker-compose-versions.yml
+        :returns: priority, defaults to normal
+
+        """
+        return (self.docker_compose_versions or {}).get("priority", "normal")
+
+    def is_converged(self):
+        """Check if the containers of the managed services already run the
+        images pinned in the docker-compose.yml, including the new versions
+        of the automatically updated services
+        :returns: True if no drift was found, False if drift was found or the
+        running state is unknown
+
+        """
+        pinned = {
+            service_name: service.image + ":" + service.next_version
+            for service_name, service in self.updated_services.get(
+                "auto_update", {}
+            ).items()
+            if not service.dockerfile_path
+        }
+        return self.get_drift(pinned) == {}
 
     def read(self):
         """Initialize the class by reading information from the
@@ -157,10 +592,16 @@ class Updater:
 
         """
         try:
-            with open(self.docker_compose_path, "r") as stream:
-                self.docker_compose = yaml.safe_load(stream)
-            with open(self.docker_compose_versions_path, "r") as stream:
-                self.docker_compose_versions = yaml.safe_load(stream)
+            with open(self.docker_compose_path, "rb") as stream:
+                docker_compose_content = stream.read()
+            with open(self.docker_compose_versions_path, "rb") as stream:
+                docker_compose_versions_content = stream.read()
+            (
+                self.docker_compose,
+                self.docker_compose_versions,
+            ) = self.parse_cache.load(
+                self.path, docker_compose_content, docker_compose_versions_content
+            )
         except FileNotFoundError as error:
             self.error_mail(error)
             sys.exit(1)
@@ -229,7 +670,12 @@ class Updater:
                     current_version = "latest"
 
                 new_service = Service(
-                    image, search_regex, current_version, dockerfile_path
+                    image,
+                    search_regex,
+                    current_version,
+                    dockerfile_path,
+                    self.tag_cache,
+                    self.docker_compose_versions.get("platforms"),
                 )
                 self.services[service_type][service_name] = new_service
 
@@ -243,32 +689,14 @@ class Updater:
         if self.dryrun:
             logging.info("Dryrun, skipping to write the file")
             return
-        # Writeout the changes. This is done manually, as using the yaml
-        # package would lead to all comments in the docker-compose.yml beeing
-        # removed.
         logging.info(
             "Writing new version for service %s to docker-compose.yml", service_name
         )
         with open(self.docker_compose_path, "r") as stream:
             docker_compose_text = stream.readlines()
-        inside_service_section = False
-        for i, _ in enumerate(docker_compose_text):
-            line = docker_compose_text[i]
-            if re.search("^ *" + service_name + ": *$", line):
-                inside_service_section = True
-            if inside_service_section and re.search("^ *image:", line):
-                # If current version is not present there was no version
-                if service.current_version not in docker_compose_text[i]:
-                    docker_compose_text[i] = line.replace(
-                        service.image, service.image + ":" + service.next_version
-                    )
-                else:
-                    docker_compose_text[i] = line.replace(
-                        service.current_version, service.next_version
-                    )
-                # As the same image can also be used for other services we
-                # have to stop here
-                break
+        docker_compose_text = update_docker_compose_lines(
+            docker_compose_text, service_name, service
+        )
         with open(self.docker_compose_path, "w") as stream:
             stream.writelines(docker_compose_text)
 
@@ -287,13 +715,7 @@ class Updater:
         # Read Dockerfile as list
         with open(service.dockerfile_path, "r") as stream:
             dockerfile = stream.readlines()
-        for i, _ in enumerate(dockerfile):
-            line = dockerfile[i]
-            if line.startswith("FROM"):
-                dockerfile[i] = " ".join(
-                    [line.split()[0], service.image + ":" + service.next_version, "\n"]
-                )
-                break
+        dockerfile = update_dockerfile_lines(dockerfile, service)
         with open(service.dockerfile_path, "w") as stream:
             stream.writelines(dockerfile)
 
@@ -329,16 +751,137 @@ class Updater:
         error_mail(error)
 
 
+class PlanError(Exception):
+
+    """A plan cannot be applied, as the project changed since it was created."""
+
+
+def update_docker_compose_lines(lines, service_name, service):
+    """Replace the version of the image of a service in the lines of a
+    docker-compose.yml. This is done manually, as using the yaml package
+    would lead to all comments in the docker-compose.yml beeing removed.
+
+    :lines: list of lines of the docker-compose.yml
+    :service_name: Name of the service in the docker-compose.yml
+    :service: Service that changed
+    :returns: list of updated lines
+
+    """
+    lines = list(lines)
+    inside_service_section = False
+    for i, line in enumerate(lines):
+        if re.search("^ *" + service_name + ": *$", line):
+            inside_service_section = True
+        if inside_service_section and re.search("^ *image:", line):
+            # If current version is not present there was no version
+            if service.current_version not in line:
+                lines[i] = line.replace(
+                    service.image, service.image + ":" + service.next_version
+                )
+            else:
+                lines[i] = line.replace(service.current_version, service.next_version)
+            # As the same image can also be used for other services we
+            # have to stop here
+            break
+    return lines
+
+
+def update_dockerfile_lines(lines, service):
+    """Replace the image of the FROM statement in the lines of a Dockerfile
+
+    :lines: list of lines of the Dockerfile
+    :service: Service that changed
+    :returns: list of updated lines
+
+    """
+    lines = list(lines)
+    for i, line in enumerate(lines):
+        if line.startswith("FROM"):
+            lines[i] = " ".join(
+                [line.split()[0], service.image + ":" + service.next_version, "\n"]
+            )
+            break
+    return lines
+
+
+def get_update_heading(service_type):
+    """Get the heading of the updates of the given type in the update mail
+
+    :service_type: auto_update or manual_update
+    :returns: Text for the update mail
+
+    """
+    if service_type == "auto_update":
+        return "\nThe following Updates where found and automatically applied:\n\n"
+    return (
+        "\nThe following Updates where found but where not applied as "
+        + "they are configured for manual updates only:\n\n"
+    )
+
+
+def get_text_hash(text):
+    """Hash the content of a file to detect changes between planning and
+    applying
+    :returns: sha256 hex digest
+
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_pull_size(tags, name, platform):
+    """Estimate the download size of a tag from the compressed image sizes
+    reported by dockerhub
+
+    :tags: list of tags of the image
+    :name: Name of the tag
+    :platform: normalized platform that is pulled, e.g. amd64
+    :returns: size in bytes or None if it is unknown
+
+    """
+    for tag in tags or []:
+        if tag["name"] != name:
+            continue
+        for image in tag.get("images") or []:
+            candidate = get_image_platform(image)
+            # A platform without variant matches all variants
+            if candidate == platform or candidate.startswith(platform + "/"):
+                return image.get("size")
+    return None
+
+
 class Service:
 
     """TODO: Docstring for Service."""
 
-    def __init__(self, image, search_regex, current_version, dockerfile_path):
+    def __init__(
+        self,
+        image,
+        search_regex,
+        current_version,
+        dockerfile_path,
+        tag_cache=None,
+        platforms=None,
+    ):  # pylint: disable=too-many-arguments
         self.image = image
         self.search_regex = search_regex
         self.current_version = current_version
         self.next_version = current_version
         self.dockerfile_path = dockerfile_path
+        # Constraints are given as mapping instead of a plain regex
+        self.constraints = None
+        if isinstance(search_regex, dict):
+            self.constraints = search_regex
+            self.search_regex = search_regex.get("regex")
+            platforms = search_regex.get("platforms", platforms)
+        if platforms is None:
+            # If no architecture is given set amd64 as default
+            platforms = os.environ.get("ARCHITECTURE", "amd64").split(",")
+        elif isinstance(platforms, str):
+            platforms = [platforms]
+        self.platforms = [normalize_platform(platform) for platform in platforms]
+        if tag_cache is None:
+            tag_cache = TagCache()
+        self.tag_cache = tag_cache
 
     def get_dockerhub_tags_for_image(self):
         """
@@ -348,29 +891,16 @@ class Service:
         logging.debug(
             "Searching for regex %s in %s tags", self.search_regex, self.image
         )
-        dockerhub_all_versions = []
-        image = self.image
-        if "/" not in image:
-            image = "library/" + self.image
-        dockerhub_versions = requests.get(
-            "https://registry.hub.docker.com/v2/repositories/"
-            + image
-            + "/tags?page_size=100"
-        )
+        dockerhub_all_versions = self.tag_cache.get(self.image)
         # Check if image was not found
-        if dockerhub_versions.status_code == 404:
+        if dockerhub_all_versions is None:
+            if self.tag_cache.offline:
+                logging.warning("No cached tags of %s, skipping it", self.image)
+                return None
             text = "The dockerimage " + self.image + " could not be found on dockerhub."
             logging.error(text)
             error_mail(text)
             return None
-
-        while True:
-            for tag in dockerhub_versions.json()["results"]:
-                dockerhub_all_versions.append(tag)
-            if dockerhub_versions.json()["next"] is None:
-                break
-            dockerhub_versions = requests.get(dockerhub_versions.json()["next"])
-
         return dockerhub_all_versions
 
     def find_next_version(self):
@@ -386,6 +916,13 @@ class Service:
         if dockerhub_versions is None:
             return
 
+        if self.constraints is not None:
+            self.find_constrained_version()
+            logging.debug("Current version: %s", self.current_version)
+            logging.debug("Newest version: %s", self.next_version)
+            return
+
+        index = self.tag_cache.get_index(self.image)
         for tag in dockerhub_versions:
             found_tag = re.search(self.search_regex, tag["name"])
             if found_tag is not None:
@@ -393,106 +930,1436 @@ class Service:
                 if packaging.version.parse(found_tag.string) > packaging.version.parse(
                     self.next_version
                 ):
-                    # Check if there is an image for the current architecture
-                    for image in tag["images"]:
-                        try:
-                            architechture = os.environ["ARCHITECTURE"]
-                        except KeyError:
-                            # If no architecture is given set amd64 as default
-                            architechture = "amd64"
-                        if image["architecture"] == architechture:
-                            self.next_version = found_tag.string
-                            break
+                    # Check if there are images for all target platforms
+                    if index.has_platforms(found_tag.string, self.platforms):
+                        self.next_version = found_tag.string
         logging.debug("Current version: %s", self.current_version)
         logging.debug("Newest version: %s", self.next_version)
 
+    def find_constrained_version(self):
+        """Search the sorted version index of the image for the newest tag
+        matching the constraints given in docker-compose-versions.yml
 
-def get_hostname():
-    """Get hostname from env variables or if not available directly form host
-    :returns: hostname
+        :returns: None
 
-    """
-    try:
-        return os.environ["DOCKER_HOST_NAME"]
-    except KeyError:
-        logging.warning(
-            "Env variable DOCKER_HOST_NAME is not set, defaulting to hostname"
-        )
-        return socket.gethostname()
+        """
+        current = VersionIndex.parse(self.current_version)
+        variant = self.constraints.get("variant", current[1] if current else "")
+        try:
+            lower, upper = get_version_bounds(self.constraints, current)
+            specifier = None
+            if "range" in self.constraints:
+                specifier = packaging.specifiers.SpecifierSet(self.constraints["range"])
+                lower, upper = narrow_version_bounds(specifier, lower, upper)
+        except (ValueError, packaging.specifiers.InvalidSpecifier) as error:
+            text = f"Invalid update constraints for {self.image}: {error}"
+            logging.error(text)
+            if not self.tag_cache.offline:
+                error_mail(text)
+            return
+        index = self.tag_cache.get_index(self.image)
+
+        def accept(name):
+            if self.search_regex is not None and not re.search(self.search_regex, name):
+                return False
+            if specifier is not None and not specifier.contains(
+                VersionIndex.format_version(VersionIndex.parse(name)[0]),
+                prereleases=True,
+            ):
+                return False
+            return index.has_platforms(name, self.platforms)
+
+        name = index.find(variant, lower, upper, accept)
+        if name is None:
+            return
+        if current is None or VersionIndex.parse(name)[0] > current[0]:
+            logging.debug("Found tag %s", name)
+            self.next_version = name
 
 
-@contextmanager
-def working_directory(directory):
-    """
-    Switches to the given directory on entry and back to the previouse one
-    when exiting the contextmanager.
-    """
-    owd = os.getcwd()
-    try:
-        os.chdir(directory)
-        yield
-    finally:
-        os.chdir(owd)
+class ParseCache:
 
+    """Services extracted from the docker-compose.yml and the
+    docker-compose-versions.yml of each project. Entries are validated by a
+    hash of the file contents, so unchanged files are not parsed again. If a
+    path is given the cache is persisted as JSON file."""
 
-def get_commandline_arguments():
-    """Commandline argument parser for this module
-    :returns: namespace with parsed arguments
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = load_json_state(path, {})
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def load(
+        self, project_path, docker_compose_content, docker_compose_versions_content
+    ):
+        """Get the parsed docker-compose.yml and docker-compose-versions.yml,
+        only the image and build sections of the services are kept
+
+        :project_path: Directory of the project
+        :docker_compose_content: content of the docker-compose.yml as bytes
+        :docker_compose_versions_content: content of the
+        docker-compose-versions.yml as bytes
+        :returns: tuple of docker-compose and docker-compose-versions data
 
-    """
-    parser = argparse.ArgumentParser()
-    parser.add_argument("path", help="Path of the docker-compose.yml")
-    parser.add_argument(
-        "-r",
-        "--recursive",
-        help="find all docker-compose-versions.yml in "
-        + "subdirectories and run the update there",
-        action="store_true",
-    )
-    parser.add_argument(
-        "-d", "--dryrun", help="only show what would happen", action="store_true"
-    )
-    args = parser.parse_args()
-    return args
+        """
+        content_hash = hashlib.sha256(
+            docker_compose_content + b"\0" + docker_compose_versions_content
+        ).hexdigest()
+        with self.lock:
+            entry = self.entries.get(project_path)
+        if entry is not None and entry["hash"] == content_hash:
+            return entry["docker_compose"], entry["docker_compose_versions"]
+        docker_compose = extract_services(load_yaml(docker_compose_content))
+        docker_compose_versions = load_yaml(docker_compose_versions_content)
+        entry = {
+            "hash": content_hash,
+            "docker_compose": docker_compose,
+            "docker_compose_versions": docker_compose_versions,
+        }
+        try:
+            json.dumps(entry)
+        except (TypeError, ValueError):
+            # Data that cannot be stored as JSON is not cached
+            return docker_compose, docker_compose_versions
+        with self.lock:
+            self.entries[project_path] = entry
+            self.changed = True
+        return docker_compose, docker_compose_versions
+
+    def save(self):
+        """Persist the cache if it changed
+        :returns: None
 
+        """
+        with self.lock:
+            if self.path is not None and self.changed:
+                save_json_state(self.path, self.entries)
+                self.changed = False
 
-def initialize_logging():
-    """Initialize logging as given in the commandline arguments
 
-    :commandline_args: namespace with commandline arguments including verbosity
-    and logfile if given
-    :returns: None
+def load_yaml(stream):
+    """Load YAML using libyaml if available
+
+    :stream: string, bytes or file
+    :returns: loaded data
 
     """
-    loglevel = os.environ.get("LOGLEVEL", "INFO")
-    try:
-        loglevel = getattr(logging, loglevel.upper())
-    except AttributeError:
-        text = f"Cannot set LOGLEVEL: Unknown LOGLEVEL {loglevel}"
-        logging.error(text)
-        error_mail(text)
-        sys.exit(1)
+    return yaml.load(stream, Loader=YAML_LOADER)
 
-    logging.getLogger().setLevel(loglevel)
 
+def extract_services(docker_compose):
+    """Reduce a docker-compose.yml to the image and build sections of its
+    services
 
-def error_mail(error):
-    """
-    Send an E-Mail with the given error message
+    :docker_compose: loaded docker-compose.yml
+    :returns: reduced docker-compose data
 
-    :returns: None
     """
-    subject = "[Dockerupdate][" + get_hostname() + "] Error in docker-compose-update"
-    text = "The following error uccured:\n" + str(error)
-    write_email(text, subject)
+    if not isinstance(docker_compose, dict) or not isinstance(
+        docker_compose.get("services"), dict
+    ):
+        return docker_compose
+    services = {}
+    for service_name, service in docker_compose["services"].items():
+        if isinstance(service, dict):
+            service = {
+                key: service[key] for key in ("image", "build") if key in service
+            }
+        services[service_name] = service
+    return {"services": services}
+
+
+class VersionIndex:
+
+    """Tags of an image grouped by their variant suffix and sorted by version,
+    e.g. 3.8.2-buster has the version (3, 8, 2) and the variant buster. Tags
+    without a numeric version like latest are not sorted. For every tag the
+    platforms it is available for are indexed."""
+
+    tag_regex = re.compile(r"^v?([0-9]+(?:\.[0-9]+)*)(?:-(.+))?$")
+
+    def __init__(self, variants, platforms=None):
+        self.variants = variants
+        self.keys = {
+            variant: [tuple(version) for version, _ in tags]
+            for variant, tags in variants.items()
+        }
+        if platforms is None:
+            platforms = {}
+        self.platforms = {name: set(values) for name, values in platforms.items()}
+
+    @classmethod
+    def from_tags(cls, tags):
+        """Build the index from a list of tags
+        :returns: VersionIndex
 
+        """
+        variants = defaultdict(list)
+        platforms = {}
+        for tag in tags or []:
+            platforms[tag["name"]] = sorted(
+                {get_image_platform(image) for image in tag.get("images") or []}
+            )
+            parsed = cls.parse(tag["name"])
+            if parsed is not None:
+                variants[parsed[1]].append([list(parsed[0]), tag["name"]])
+        for variant_tags in variants.values():
+            variant_tags.sort()
+        return cls(dict(variants), platforms)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Load an index serialized with to_dict
+        :returns: VersionIndex
 
-def write_email(msg_text, msg_subject):
-    """Writes an e-mail with the given text and subject
+        """
+        return cls(data["variants"], data["platforms"])
+
+    @classmethod
+    def parse(cls, name):
+        """Split a tag into its version and variant
+
+        :name: Name of the tag
+        :returns: tuple of version tuple and variant or None if the tag has no
+        numeric version
+
+        """
+        match = cls.tag_regex.match(name)
+        if match is None:
+            return None
+        version = tuple(int(part) for part in match.group(1).split("."))
+        return version, match.group(2) or ""
+
+    @staticmethod
+    def format_version(version):
+        """Format a version tuple as string
+        :returns: e.g. 3.8.2
+
+        """
+        return ".".join(str(part) for part in version)
+
+    def to_dict(self):
+        """Serialize the index for the tag cache
+        :returns: dict of variants with their sorted tags and of the platforms
+        of each tag
+
+        """
+        return {
+            "variants": self.variants,
+            "platforms": {
+                name: sorted(values) for name, values in self.platforms.items()
+            },
+        }
+
+    def has_platforms(self, name, platforms):
+        """Check if a tag is available for all given platforms
+
+        :name: Name of the tag
+        :platforms: list of normalized platforms, e.g. amd64 or arm64/v8
+        :returns: True if images for all platforms exist
+
+        """
+        available = self.platforms.get(name, set())
+        for platform in platforms:
+            # A platform without variant matches all variants
+            if platform not in available and not any(
+                candidate.startswith(platform + "/") for candidate in available
+            ):
+                return False
+        return True
+
+    def find(self, variant, lower=None, upper=None, accept=None):
+        """Binary search for the newest tag of the given variant within the
+        given bounds
+
+        :variant: Variant of the tag, empty for tags without suffix
+        :lower: Inclusive lower version bound
+        :upper: Exclusive upper version bound
+        :accept: Optional function to filter the names of the tags
+        :returns: Name of the newest tag or None if nothing was found
+
+        """
+        keys = self.keys.get(variant, [])
+        start = 0 if lower is None else bisect_left(keys, tuple(lower))
+        end = len(keys) if upper is None else bisect_left(keys, tuple(upper))
+        for position in range(end - 1, start - 1, -1):
+            name = self.variants[variant][position][1]
+            if accept is None or accept(name):
+                return name
+        return None
+
+
+def get_image_platform(image):
+    """Get the platform of an image of a tag as returned by dockerhub
+
+    :image: image as returned by dockerhub
+    :returns: normalized platform, e.g. amd64 or arm64/v8
+
+    """
+    platform = [image.get("os") or "linux", image.get("architecture") or ""]
+    if image.get("variant"):
+        platform.append(image["variant"])
+    return normalize_platform("/".join(platform))
+
+
+def normalize_platform(platform):
+    """Normalize a platform, linux is the default operating system
+
+    :platform: e.g. linux/arm64/v8, arm64 or windows/amd64
+    :returns: e.g. arm64/v8, arm64 or windows/amd64
+
+    """
+    platform = str(platform).strip().lower()
+    if platform.startswith("linux/"):
+        platform = platform.replace("linux/", "", 1)
+    return platform
+
+
+def get_version_bounds(constraints, current):
+    """Get the version bounds for the update policy given in the constraints
+
+    :constraints: dict of constraints from docker-compose-versions.yml
+    :current: parsed current version or None if it has no numeric version
+    :returns: tuple of inclusive lower and exclusive upper bound, None if
+    unbounded
+
+    """
+    policy = constraints.get("policy", "major")
+    if policy not in ("patch", "minor", "major"):
+        raise ValueError(f"Unknown update policy {policy}")
+    if current is None:
+        return None, None
+    version = current[0]
+    if policy == "patch":
+        if len(version) < 2:
+            raise ValueError(f"Version {version} has no minor version")
+        return version, (version[0], version[1] + 1)
+    if policy == "minor":
+        return version, (version[0] + 1,)
+    return version, None
+
+
+def narrow_version_bounds(specifier, lower, upper):
+    """Narrow the version bounds by the lower and upper limits of a version
+    range, the range itself still has to be checked for every tag
+
+    :specifier: packaging SpecifierSet
+    :lower: Inclusive lower version bound or None
+    :upper: Exclusive upper version bound or None
+    :returns: tuple of narrowed lower and upper bound
+
+    """
+    for single_specifier in specifier:
+        parsed = VersionIndex.parse(single_specifier.version)
+        if parsed is None:
+            continue
+        if single_specifier.operator in (">=", ">"):
+            if lower is None or parsed[0] > tuple(lower):
+                lower = parsed[0]
+        elif single_specifier.operator == "<":
+            if upper is None or parsed[0] < tuple(upper):
+                upper = parsed[0]
+    return lower, upper
+
+
+class TagCache:
+
+    """Tags of docker images, fetched at most once per TTL. Concurrent requests
+    for the same image are coalesced into a single fetch. If a path is given
+    the cache is persisted in that directory with one JSON file per image, so
+    only the images that are used are read and a fetch only writes the file of
+    its image. If a shard is given, images owned by other shards are only
+    fetched if their cached tags are missing or much older than the TTL, as
+    the other shards refresh them in the shared directory.
+    An offline cache never fetches and uses the cached tags regardless of
+    their age."""
+
+    # Factor of the TTL up to which tags refreshed by other shards are used
+    shard_grace = 4
+
+    def __init__(
+        self,
+        path=None,
+        ttl=None,
+        image_ttls=None,
+        fetch=None,
+        shard=None,
+        offline=False,
+    ):  # pylint: disable=too-many-arguments
+        self.path = path
+        self.shard = shard
+        self.offline = offline
+        if ttl is None:
+            ttl = int(os.environ.get("TAG_CACHE_TTL", 3600))
+        self.ttl = ttl
+        if image_ttls is None:
+            image_ttls = parse_image_ttls(os.environ.get("TAG_CACHE_IMAGE_TTLS", ""))
+        self.image_ttls = image_ttls
+        if fetch is None:
+            fetch = fetch_tags
+        self.fetch = fetch
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.entries = {}
+        self.loaded = set()
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.image_locks = defaultdict(threading.Lock)
+
+    def get_entry_path(self, image):
+        """Get the path of the file the tags of the given image are kept in
+        :returns: path or None if the cache is not persisted
+
+        """
+        if self.path is None:
+            return None
+        return os.path.join(self.path, urllib.parse.quote(image, safe="") + ".json")
+
+    def load(self, image):
+        """Load the persisted tags of the given image once
+        :returns: None
+
+        """
+        with self.lock:
+            if image in self.loaded:
+                return
+            self.loaded.add(image)
+            entry = load_json_state(self.get_entry_path(image), None)
+            if entry is not None and image not in self.entries:
+                self.entries[image] = entry
+
+    def get_ttl(self, image):
+        """Get the TTL of the given image
+        :returns: TTL in seconds
+
+        """
+        return self.image_ttls.get(image, self.ttl)
+
+    def is_fresh(self, image, max_age=None):
+        """Check if the cached tags of the given image can be used
+
+        :image: Name of the image
+        :max_age: Maximum accepted age in seconds, defaults to the image TTL
+        :returns: True if a fresh entry exists
+
+        """
+        self.load(image)
+        entry = self.entries.get(image)
+        if entry is None:
+            return False
+        if max_age is None:
+            max_age = self.get_ttl(image)
+        return time.time() - entry["fetched"] < max_age
+
+    def get(self, image, max_age=None):
+        """Get the tags of the given image, fetching them if the cached ones
+        are missing or expired
+
+        :image: Name of the image
+        :max_age: Maximum accepted age in seconds, defaults to the image TTL
+        :returns: list of tags or None if the image does not exist
+
+        """
+        if self.is_fresh(image, max_age):
+            return self.entries[image]["tags"]
+        if self.offline:
+            return self.entries.get(image, {}).get("tags")
+        with self.lock:
+            image_lock = self.image_locks[image]
+        with image_lock:
+            # Another thread may have fetched the tags while we were waiting
+            if self.is_fresh(image, max_age):
+                return self.entries[image]["tags"]
+            if self.shard is not None and not self.shard.owns(image):
+                # Use the tags refreshed by the shard owning the image, only
+                # the file of this image is read
+                self.reload(image)
+                if self.is_fresh(
+                    image, self.shard_grace * (max_age or self.get_ttl(image))
+                ):
+                    return self.entries[image]["tags"]
+            tags = self.fetch(image)
+            self.put(image, tags)
+            return tags
+
+    def get_index(self, image):
+        """Get the sorted version index of the given image, the index is built
+        once per fetch and persisted with the tags
+
+        :image: Name of the image
+        :returns: VersionIndex
+
+        """
+        self.load(image)
+        with self.lock:
+            if image not in self.indexes:
+                entry = self.entries.get(image) or {}
+                if "platforms" in entry.get("index", {}):
+                    self.indexes[image] = VersionIndex.from_dict(entry["index"])
+                else:
+                    self.indexes[image] = VersionIndex.from_tags(entry.get("tags"))
+            return self.indexes[image]
+
+    def put(self, image, tags):
+        """Store the tags of an image with their version index and persist
+        them
+        :returns: None
+
+        """
+        index = VersionIndex.from_tags(tags)
+        entry = {"fetched": time.time(), "tags": tags, "index": index.to_dict()}
+        with self.lock:
+            self.entries[image] = entry
+            self.loaded.add(image)
+            self.indexes[image] = index
+        if self.path is not None:
+            save_json_state(self.get_entry_path(image), entry)
+
+    def reload(self, image):
+        """Reload the tags of the given image if another process persisted
+        newer ones
+        :returns: None
+
+        """
+        entry = load_json_state(self.get_entry_path(image), None)
+        with self.lock:
+            self.loaded.add(image)
+            if entry is not None and (
+                image not in self.entries
+                or entry["fetched"] > self.entries[image]["fetched"]
+            ):
+                self.entries[image] = entry
+                self.indexes.pop(image, None)
+
+
+def load_tag_snapshot(path):
+    """Load an offline tag cache from a snapshot file, a JSON object mapping
+    images to their list of tags or to their tag cache entries
+
+    :path: Path of the snapshot
+    :returns: TagCache that never fetches
+
+    """
+    with open(path, "r") as stream:
+        snapshot = json.load(stream)
+    tag_cache = TagCache(offline=True)
+    for image, entry in snapshot.items():
+        if isinstance(entry, list):
+            entry = {"fetched": 0, "tags": entry}
+        tag_cache.entries[image] = entry
+    return tag_cache
+
+
+class TagCacheRequestHandler(BaseHTTPRequestHandler):
+
+    """Serves the tags of a TagCache under /tags/<image>."""
+
+    tag_cache = None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer a tag request
+        :returns: None
+
+        """
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.startswith("/tags/"):
+            self.send_error(404)
+            return
+        image = urllib.parse.unquote(url.path.replace("/tags/", "", 1))
+        max_age = urllib.parse.parse_qs(url.query).get("max_age")
+        try:
+            tags = self.tag_cache.get(image, int(max_age[0]) if max_age else None)
+        except (requests.RequestException, ValueError, KeyError) as error:
+            logging.error("Could not get tags for %s: %s", image, error)
+            self.send_error(502)
+            return
+        if tags is None:
+            self.send_error(404)
+            return
+        content = json.dumps(tags).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve_tag_cache(port, tag_cache):
+    """Serve the given TagCache over HTTP until the process is stopped
+
+    :port: Port to listen on
+    :tag_cache: TagCache to serve
+    :returns: None
+
+    """
+    TagCacheRequestHandler.tag_cache = tag_cache
+    httpd = ThreadingHTTPServer(("", port), TagCacheRequestHandler)
+    logging.info("Serving tag cache on port %s", port)
+    httpd.serve_forever()
+
+
+def fetch_tags(image):
+    """Fetch the tags of an image from the shared tag cache given in
+    TAG_CACHE_URL, falls back to dockerhub if no shared cache is configured or
+    it is not reachable
+
+    :image: Name of the image
+    :returns: list of tags or None if the image does not exist
+
+    """
+    tag_cache_url = os.environ.get("TAG_CACHE_URL")
+    if not tag_cache_url:
+        return fetch_dockerhub_tags(image)
+    try:
+        response = requests.get(
+            tag_cache_url.rstrip("/") + "/tags/" + urllib.parse.quote(image),
+            timeout=300,
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError) as error:
+        logging.warning(
+            "Shared tag cache %s failed, falling back to dockerhub: %s",
+            tag_cache_url,
+            error,
+        )
+        return fetch_dockerhub_tags(image)
+
+
+def fetch_dockerhub_tags(image):
+    """
+    Get all tags available on dockerhub under the given image
+    :returns: list of tags or None if the image does not exist
+    """
+    if "/" not in image:
+        image = "library/" + image
+    dockerhub_versions = requests.get(
+        "https://registry.hub.docker.com/v2/repositories/"
+        + image
+        + "/tags?page_size=100"
+    )
+    record_rate_limit(dockerhub_versions)
+    # Check if image was not found
+    if dockerhub_versions.status_code == 404:
+        return None
+
+    dockerhub_all_versions = []
+    while True:
+        for tag in dockerhub_versions.json()["results"]:
+            dockerhub_all_versions.append(compact_tag(tag))
+        if dockerhub_versions.json()["next"] is None:
+            break
+        dockerhub_versions = requests.get(dockerhub_versions.json()["next"])
+        record_rate_limit(dockerhub_versions)
+
+    return dockerhub_all_versions
+
+
+def compact_tag(tag):
+    """Reduce a tag returned by dockerhub to the fields used by this module,
+    this keeps the tag cache small
+
+    :tag: tag as returned by dockerhub
+    :returns: reduced tag
+
+    """
+    return {
+        "name": tag["name"],
+        "last_updated": tag.get("last_updated"),
+        "images": [
+            {
+                key: image[key]
+                for key in ("architecture", "os", "variant", "digest", "size")
+                if key in image
+            }
+            for image in tag.get("images") or []
+        ],
+    }
+
+
+def parse_image_ttls(text):
+    """Parse per image TTLs given as comma separated list of image=seconds
+
+    :text: e.g. "node=300,python=3600"
+    :returns: dict of image and TTL
+
+    """
+    image_ttls = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        image, ttl = item.rsplit("=", 1)
+        image_ttls[image.strip()] = int(ttl)
+    return image_ttls
+
+
+def get_state_path(name):
+    """Get the path of a state file in the directory given by STATE_DIR
+    :name: Name of the state file
+    :returns: path or None if no state directory is configured
+
+    """
+    state_dir = os.environ.get("STATE_DIR")
+    if not state_dir:
+        return None
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, name)
+
+
+class Shard:
+
+    """Deterministic partition of projects and images between several
+    updater processes, based on a stable hash."""
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a shard given as i/n, where i counts from 0 to n - 1
+
+        :text: e.g. 0/3
+        :returns: Shard
+
+        """
+        try:
+            index, count = (int(part) for part in text.split("/"))
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(
+                f"invalid shard {text}, expected i/n"
+            ) from error
+        if count < 1 or not 0 <= index < count:
+            raise argparse.ArgumentTypeError(
+                f"invalid shard {text}, i has to be between 0 and n - 1"
+            )
+        return cls(index, count)
+
+    def owns(self, key):
+        """Check if the given project path or image belongs to this shard
+
+        :key: project path relative to the searched directory or image name
+        :returns: True if this shard is responsible for the key
+
+        """
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return int(digest, 16) % self.count == self.index
+
+    def get_state_name(self, name):
+        """Get the name of a state file that is not shared between shards
+
+        :name: e.g. run.lock
+        :returns: e.g. run-0-of-3.lock
+
+        """
+        base, extension = os.path.splitext(name)
+        return f"{base}-{self.index}-of-{self.count}{extension}"
+
+
+def get_shard_state_name(name, shard):
+    """Get the name of a state file that is kept per shard
+
+    :name: Name of the state file
+    :shard: Shard or None if the run is not sharded
+    :returns: name of the state file
+
+    """
+    if shard is None:
+        return name
+    return shard.get_state_name(name)
+
+
+def get_shard_state_path(name, shard):
+    """Get the path of a state file that is kept per shard in STATE_DIR
+
+    :name: Name of the state file
+    :shard: Shard or None if the run is not sharded
+    :returns: path or None if no state directory is configured
+
+    """
+    return get_state_path(get_shard_state_name(name, shard))
+
+
+def load_json_state(path, default):
+    """Load a JSON state file
+
+    :path: Path of the state file, may be None
+    :default: Value returned if the file is missing or broken
+    :returns: loaded state
 
-    :msg_text:(str) Message text
-    :msg_subject:(str) Message subject
-    :returns: None
+    """
+    if path is None:
+        return default
+    try:
+        with open(path, "r") as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return default
+    except ValueError as error:
+        logging.warning("Ignoring broken state file %s: %s", path, error)
+        return default
+
+
+def save_json_state(path, state):
+    """Atomically write a JSON state file
+
+    :path: Path of the state file
+    :state: JSON serializable state
+    :returns: None
+
+    """
+    temporary_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temporary_path, "w") as stream:
+        json.dump(state, stream)
+    os.replace(temporary_path, path)
+
+
+class PollScheduler:
+
+    """Assigns every image a time for its next registry check. The interval
+    follows the observed release frequency of the image, the priority of the
+    projects using it and the remaining dockerhub rate limit. A hash based
+    offset spreads the checks of different images over the day. The schedule
+    is kept in memory and persisted once per run with save()."""
+
+    min_interval = 15 * 60
+    max_interval = 24 * 60 * 60
+    default_interval = 6 * 60 * 60
+
+    def __init__(self, path=None):
+        self.path = path
+        self.state = load_json_state(path, {})
+        self.recorded = set()
+        self.lock = threading.Lock()
+        self.changed = False
+
+    def is_due(self, image):
+        """Check if the given image has to be checked in this run. Images that
+        were already checked in this run are due as their tags are cached.
+
+        :image: Name of the image
+        :returns: True if the image is due
+
+        """
+        with self.lock:
+            if image in self.recorded or image not in self.state:
+                return True
+            return self.state[image]["next_check"] <= time.time()
+
+    def record(self, image, tags, priority="normal"):
+        """Record a check of the image and schedule the next one
+
+        :image: Name of the image
+        :tags: list of tags of the image, None if the image was not found
+        :priority: priority of the project, high, normal, low or a factor
+        :returns: None
+
+        """
+        interval = self.get_interval(tags, priority)
+        # Spread images with the same interval evenly
+        offset = zlib.crc32(image.encode("utf-8")) / 2**32
+        next_check = time.time() + interval * (0.75 + 0.5 * offset)
+        with self.lock:
+            # The project with the highest priority determines the next check
+            if image in self.recorded:
+                next_check = min(next_check, self.state[image]["next_check"])
+            self.recorded.add(image)
+            self.state[image] = {"next_check": next_check, "interval": interval}
+            self.changed = True
+        logging.debug(
+            "Next check of image %s in %d seconds", image, next_check - time.time()
+        )
+
+    def save(self):
+        """Persist the schedule if it changed
+        :returns: None
+
+        """
+        with self.lock:
+            if self.path is not None and self.changed:
+                save_json_state(self.path, self.state)
+                self.changed = False
+
+    def get_interval(self, tags, priority="normal"):
+        """Get the check interval for an image
+
+        :tags: list of tags of the image
+        :priority: priority of the project, high, normal, low or a factor
+        :returns: interval in seconds
+
+        """
+        release_interval = get_release_interval(tags)
+        if release_interval is None:
+            interval = self.default_interval
+        else:
+            # Check a few times per release
+            interval = release_interval / 4
+        interval *= get_priority_factor(priority)
+        # Slow down if the rate limit is running out
+        limit = DOCKERHUB_RATE_LIMIT.get("limit")
+        remaining = DOCKERHUB_RATE_LIMIT.get("remaining")
+        if limit and remaining is not None and remaining < limit / 2:
+            interval /= max(2 * remaining / limit, 0.1)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+
+PRIORITIES = {"high": 0.25, "normal": 1, "low": 4}
+
+
+def get_priority_factor(priority):
+    """Get the factor for the check interval of a priority, projects with a
+    smaller factor are checked more often and processed first
+
+    :priority: high, normal, low or a factor
+    :returns: factor
+
+    """
+    try:
+        return float(PRIORITIES.get(priority, priority))
+    except (TypeError, ValueError):
+        logging.warning("Unknown priority %s, using normal", priority)
+        return 1.0
+
+
+def get_release_interval(tags, releases=20):
+    """Get the median time between the latest releases of an image
+
+    :tags: list of tags of the image
+    :releases: number of releases to consider
+    :returns: interval in seconds or None if it cannot be determined
+
+    """
+    timestamps = set()
+    for tag in tags or []:
+        try:
+            timestamps.add(
+                datetime.fromisoformat(
+                    tag["last_updated"].replace("Z", "+00:00")
+                ).timestamp()
+            )
+        except (KeyError, AttributeError, ValueError):
+            continue
+    timestamps = sorted(timestamps)[-releases:]
+    if len(timestamps) < 2:
+        return None
+    return statistics.median(
+        later - earlier for earlier, later in zip(timestamps, timestamps[1:])
+    )
+
+
+# Rate limit reported by the last dockerhub response
+DOCKERHUB_RATE_LIMIT = {}
+
+# The ProjectRun of the current thread, used to cancel its compose commands
+CURRENT_PROJECT_RUN = threading.local()
+
+
+def record_rate_limit(response):
+    """Remember the rate limit reported in the headers of a dockerhub response
+
+    :response: requests response
+    :returns: None
+
+    """
+    for key in ("limit", "remaining"):
+        value = response.headers.get("X-RateLimit-" + key.capitalize())
+        if value is None:
+            continue
+        try:
+            DOCKERHUB_RATE_LIMIT[key] = int(value.split(";")[0])
+        except ValueError:
+            continue
+
+
+class DockerEngineError(Exception):
+
+    """Error response of the Docker Engine API."""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    """HTTPConnection talking to a unix domain socket."""
+
+    def __init__(self, socket_path, timeout=10):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerEngine:
+
+    """Minimal client for the Docker Engine API on the mounted docker socket."""
+
+    def __init__(self, socket_path=None):
+        if socket_path is None:
+            socket_path = os.environ.get("DOCKER_SOCKET", "/var/run/docker.sock")
+        self.socket_path = socket_path
+        self.connection = None
+
+    def request(self, method, path):
+        """Send a request to the Docker Engine API, the connection is kept
+        open and reused by following requests.
+
+        :method: HTTP method
+        :path: API path including the query string
+        :returns: decoded JSON response or None for empty responses
+
+        """
+        if self.connection is None:
+            self.connection = UnixHTTPConnection(self.socket_path)
+        try:
+            self.connection.request(method, path)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.status >= 400:
+            raise DockerEngineError(
+                f"{method} {path} failed with status {response.status}: "
+                + body.decode("utf-8", "replace").strip()
+            )
+        if not body:
+            return None
+        return json.loads(body)
+
+    def close(self):
+        """Close the connection to the docker socket
+        :returns: None
+
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class RunningState:
+
+    """Snapshot of the running compose containers and the local images, taken
+    with one bulk request each."""
+
+    working_dir_label = "com.docker.compose.project.working_dir"
+    service_label = "com.docker.compose.service"
+    oneoff_label = "com.docker.compose.oneoff"
+    not_running = "no running container"
+
+    def __init__(self, containers, images):
+        self.containers = defaultdict(list)
+        for container in containers:
+            labels = container.get("Labels") or {}
+            # Containers of docker compose run are not service containers
+            if (
+                self.working_dir_label not in labels
+                or labels.get(self.oneoff_label) == "True"
+            ):
+                continue
+            key = (
+                os.path.normpath(labels[self.working_dir_label]),
+                labels.get(self.service_label),
+            )
+            self.containers[key].append(container)
+        self.image_ids = {}
+        for image in images:
+            for tag in image.get("RepoTags") or []:
+                self.image_ids[normalize_image_reference(tag)] = image["Id"]
+
+    @classmethod
+    def from_engine(cls, engine):
+        """Take a snapshot using the given DockerEngine
+        :returns: RunningState
+
+        """
+        return cls(
+            engine.request("GET", "/containers/json"),
+            engine.request("GET", "/images/json"),
+        )
+
+    def get_drift(self, path, service_name, image):
+        """Compare the running containers of a service with the given image
+
+        :path: Directory of the docker-compose.yml
+        :service_name: Name of the service in the docker-compose.yml
+        :image: Pinned image reference, None if the image is built locally
+        :returns: Description of the drift or None if the service is converged
+
+        """
+        containers = self.containers.get((os.path.normpath(path), service_name))
+        if not containers:
+            return self.not_running
+        if image is None:
+            return None
+        reference = normalize_image_reference(image)
+        image_id = self.image_ids.get(reference)
+        if image_id is None:
+            return "pinned image " + image + " is not available locally"
+        for container in containers:
+            running = container.get("Image", "")
+            if not running.startswith("sha256:"):
+                running = normalize_image_reference(running)
+                if running != reference:
+                    return "running " + running + " instead of " + reference
+            if container.get("ImageID") != image_id:
+                return "running an outdated digest of " + reference
+        return None
+
+
+def get_container_health(container):
+    """Get the health of a container from the Docker Engine API container list
+
+    :container: container as returned by /containers/json
+    :returns: healthy, starting or the failed state of the container
+
+    """
+    state = container.get("State", "")
+    status = container.get("Status", "")
+    if state != "running":
+        return state or "unknown"
+    if "(unhealthy)" in status:
+        return "unhealthy"
+    if "(health: starting)" in status:
+        return "starting"
+    return "healthy"
+
+
+def rank_health(health):
+    """Rank a container health, containers that are still starting get time
+    until the deadline
+
+    :health: as returned by get_container_health
+    :returns: 0 for healthy, 1 for pending and 2 for failed containers
+
+    """
+    if health == "healthy":
+        return 0
+    if health in ("starting", "restarting", "created", "missing"):
+        return 1
+    return 2
+
+
+def wait_for_health(
+    engine, path, service_names, timeout, interval=2
+):  # pylint: disable=too-many-arguments
+    """Poll the containers of the given services until all of them are
+    healthy, one of them failed or the timeout is reached. All services are
+    polled with a single request.
+
+    :engine: DockerEngine
+    :path: Directory of the docker-compose.yml
+    :service_names: Names of the services to check
+    :timeout: Timeout in seconds
+    :interval: Seconds between two polls
+    :returns: dict of service name and state for all services that are not
+    healthy, empty if all services are healthy
+
+    """
+    # Exited containers of docker compose run carry the same service label
+    filters = json.dumps(
+        {
+            "label": [
+                RunningState.working_dir_label + "=" + os.path.normpath(path),
+                RunningState.oneoff_label + "=False",
+            ]
+        }
+    )
+    deadline = time.monotonic() + timeout
+    while True:
+        time.sleep(interval)
+        containers = engine.request(
+            "GET", "/containers/json?all=1&filters=" + urllib.parse.quote(filters)
+        )
+        states = {service_name: "missing" for service_name in service_names}
+        for container in containers:
+            service_name = (container.get("Labels") or {}).get(
+                RunningState.service_label
+            )
+            if service_name not in states:
+                continue
+            health = get_container_health(container)
+            # With several replicas the worst state counts
+            previous = states[service_name]
+            if previous == "missing" or rank_health(health) > rank_health(previous):
+                states[service_name] = health
+        unhealthy = {
+            service_name: state
+            for service_name, state in states.items()
+            if state != "healthy"
+        }
+        if not unhealthy:
+            return {}
+        if any(rank_health(state) > 1 for state in unhealthy.values()):
+            return unhealthy
+        if time.monotonic() >= deadline:
+            return unhealthy
+
+
+def normalize_image_reference(image):
+    """Normalize an image reference so that equal images compare equal, e.g.
+    python, library/python:latest and docker.io/library/python:latest
+
+    :image: image reference
+    :returns: normalized image reference
+
+    """
+    image = image.split("@")[0]
+    for prefix in ("docker.io/", "index.docker.io/", "library/"):
+        if image.startswith(prefix):
+            image = image.replace(prefix, "", 1)
+    if ":" not in image.split("/")[-1]:
+        image = image + ":latest"
+    return image
+
+
+def prune_images(engine, images, keep):
+    """Remove older versions of the given images with one request listing the
+    local images and the removals sent over the same connection. Only images
+    whose tags are all of the same variant and older than the current version
+    are removed, images still used by containers are kept by the Docker
+    Engine.
+
+    :engine: DockerEngine
+    :images: dict of image name and current version
+    :keep: number of previous images to keep per image
+    :returns: list of the tags of the removed images
+
+    """
+    current = {}
+    for image, version in images.items():
+        parsed = VersionIndex.parse(version)
+        if parsed is not None:
+            current[normalize_image_reference(image + ":" + version)] = parsed
+    previous = defaultdict(list)
+    for local_image in engine.request("GET", "/images/json"):
+        references = [
+            normalize_image_reference(tag) for tag in local_image.get("RepoTags") or []
+        ]
+        for current_reference, current_parsed in current.items():
+            versions = []
+            for reference in references:
+                repository, version = reference.rsplit(":", 1)
+                parsed = VersionIndex.parse(version)
+                if (
+                    parsed is None
+                    or current_reference.rsplit(":", 1)[0] != repository
+                    or parsed[1] != current_parsed[1]
+                    or parsed[0] >= current_parsed[0]
+                ):
+                    break
+                versions.append(parsed[0])
+            else:
+                # Images with other tags, e.g. the current version, are kept
+                if versions:
+                    previous[current_reference].append(
+                        (max(versions), local_image["Id"], references)
+                    )
+    removed = []
+    for candidates in previous.values():
+        candidates.sort(reverse=True)
+        for _, image_id, references in candidates[keep:]:
+            # Deleting by id removes all tags of the image at once
+            try:
+                engine.request("DELETE", "/images/" + image_id)
+            except DockerEngineError as error:
+                logging.info("Keeping image %s: %s", ", ".join(references), error)
+                continue
+            logging.info("Removed superseded image %s", ", ".join(references))
+            removed.append(", ".join(references))
+    return removed
+
+
+def get_running_state():
+    """Take a snapshot of the running containers through the docker socket
+    :returns: RunningState or None if the docker socket is not available
+
+    """
+    engine = DockerEngine()
+    try:
+        return RunningState.from_engine(engine)
+    except (OSError, http.client.HTTPException, DockerEngineError) as error:
+        logging.warning(
+            "Cannot read running containers from %s, skipping verification: %s",
+            engine.socket_path,
+            error,
+        )
+        return None
+    finally:
+        engine.close()
+
+
+def get_hostname():
+    """Get hostname from env variables or if not available directly form host
+    :returns: hostname
+
+    """
+    try:
+        return os.environ["DOCKER_HOST_NAME"]
+    except KeyError:
+        logging.warning(
+            "Env variable DOCKER_HOST_NAME is not set, defaulting to hostname"
+        )
+        return socket.gethostname()
+
+
+def get_commandline_arguments():
+    """Commandline argument parser for this module
+    :returns: namespace with parsed arguments
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", help="Path of the docker-compose.yml")
+    parser.add_argument(
+        "-r",
+        "--recursive",
+        help="find all docker-compose-versions.yml in "
+        + "subdirectories and run the update there",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d", "--dryrun", help="only show what would happen", action="store_true"
+    )
+    parser.add_argument(
+        "--serve-tag-cache",
+        metavar="PORT",
+        type=int,
+        help="serve a shared tag cache for other hosts on the given port "
+        + "instead of running the updater",
+    )
+    parser.add_argument(
+        "-s",
+        "--schedule",
+        help="only check images that are due according to their release "
+        + "frequency and priority, requires STATE_DIR",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of projects updated in parallel in recursive mode",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        help="timeout in seconds for updating a single project in recursive mode",
+        type=int,
+        default=1800,
+    )
+    parser.add_argument(
+        "--rollout-timeout",
+        help="seconds to wait for updated services to become healthy before "
+        + "rolling them back, 0 disables the health check",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--wait-lock",
+        help="seconds to wait for a running update to finish, by default the "
+        + "script exits immediately if another run is in progress",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--deadline",
+        help="time budget of a recursive run in seconds, projects that do not "
+        + "fit are deferred to the next run",
+        type=int,
+    )
+    parser.add_argument(
+        "--compose-timeout",
+        help="timeout in seconds for a single docker compose command",
+        type=int,
+        default=900,
+    )
+    parser.add_argument(
+        "--keep-images",
+        help="remove superseded images of automatically updated services, "
+        + "keeping the given number of previous versions, 0 disables pruning",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--shard",
+        help="only process the projects and refresh the images belonging to "
+        + "shard i of n, where i counts from 0 to n - 1",
+        metavar="i/n",
+        type=Shard.parse,
+    )
+    parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="search for updates in the cached tags only, without network or "
+        + "docker access, and write the planned changes to FILE, - for stdout",
+    )
+    parser.add_argument(
+        "--tag-snapshot",
+        metavar="FILE",
+        help="plan with the tags in this JSON file instead of the tag cache",
+    )
+    parser.add_argument(
+        "--apply-plan",
+        metavar="FILE",
+        help="apply the changes of a plan written with --plan without "
+        + "searching for updates again",
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("the number of workers has to be at least 1")
+    if args.plan is not None and args.apply_plan is not None:
+        parser.error("--plan and --apply-plan cannot be combined")
+    if args.tag_snapshot is not None and args.plan is None:
+        parser.error("--tag-snapshot requires --plan")
+    if args.path is None and args.serve_tag_cache is None and args.apply_plan is None:
+        parser.error("the following arguments are required: path")
+    return args
+
+
+def initialize_logging():
+    """Initialize logging as given in the commandline arguments
+
+    :commandline_args: namespace with commandline arguments including verbosity
+    and logfile if given
+    :returns: None
+
+    """
+    loglevel = os.environ.get("LOGLEVEL", "INFO")
+    try:
+        loglevel = getattr(logging, loglevel.upper())
+    except AttributeError:
+        text = f"Cannot set LOGLEVEL: Unknown LOGLEVEL {loglevel}"
+        logging.error(text)
+        error_mail(text)
+        sys.exit(1)
+
+    logging.getLogger().setLevel(loglevel)
+
+
+def error_mail(error):
+    """
+    Send an E-Mail with the given error message
+
+    :returns: None
+    """
+    subject = "[Dockerupdate][" + get_hostname() + "] Error in docker-compose-update"
+    text = "The following error uccured:\n" + str(error)
+    write_email(text, subject)
+
+
+def write_email(msg_text, msg_subject):
+    """Writes an e-mail with the given text and subject
+
+    :msg_text:(str) Message text
+    :msg_subject:(str) Message subject
+    :returns: None
     """
     try:
         smtp_server_domain = os.environ["MAIL_SMTP_SERVER"]
@@ -577,6 +2444,594 @@ def get_docker_compose_directories(base_path):
             yield from get_docker_compose_directories(path)
 
 
+class ComposeStep:
+
+    """Result of a docker compose command."""
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.returncode = None
+        self.output = []
+        self.duration = 0.0
+        self.timed_out = False
+        self.error = None
+
+    @property
+    def succeeded(self):
+        """True if the command exited successfully"""
+        return self.returncode == 0 and not self.timed_out
+
+    def get_error(self):
+        """Describe why the command failed
+        :returns: description
+
+        """
+        if self.error is not None:
+            return str(self.error)
+        if self.timed_out:
+            return f"timed out after {self.duration:.0f} seconds"
+        return f"exited with code {self.returncode}"
+
+
+def run_compose(args, cwd, timeout=None):
+    """Run a docker compose command, the command is given by
+    DOCKER_COMPOSE_COMMAND and defaults to docker compose
+
+    :args: arguments for docker compose
+    :cwd: directory of the docker-compose.yml
+    :timeout: timeout in seconds, the command is killed afterwards
+    :returns: ComposeStep
+
+    """
+    argv = shlex.split(os.environ.get("DOCKER_COMPOSE_COMMAND", "docker compose"))
+    argv.extend(args)
+    project_run = getattr(CURRENT_PROJECT_RUN, "value", None)
+    if project_run is not None and project_run.cancelled is not None:
+        step = ComposeStep(argv)
+        step.error = "cancelled, the project " + project_run.cancelled
+        return step
+    return asyncio.run(run_command(argv, cwd, timeout))
+
+
+async def run_command(argv, cwd, timeout=None):
+    """Run a command, stdout and stderr are streamed to the log and captured
+
+    :argv: command and its arguments
+    :cwd: working directory of the command
+    :timeout: timeout in seconds, the command is killed afterwards
+    :returns: ComposeStep
+
+    """
+    step = ComposeStep(argv)
+    started = time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            cwd=cwd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # A process group allows to kill child processes on timeout
+            start_new_session=True,
+        )
+    except OSError as error:
+        step.error = error
+        return step
+    project_run = getattr(CURRENT_PROJECT_RUN, "value", None)
+    if project_run is not None:
+        project_run.add_process_group(process.pid)
+
+    def add_line(line):
+        line = line.decode("utf-8", "replace").rstrip()
+        logging.debug("%s: %s", cwd, line)
+        step.output.append(line)
+
+    async def read_stream(stream):
+        # Read in chunks, lines of build output can exceed the line limit of
+        # the StreamReader
+        rest = b""
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                add_line(line)
+        if rest:
+            add_line(rest)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                read_stream(process.stdout), read_stream(process.stderr), process.wait()
+            ),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        step.timed_out = True
+    except Exception as error:  # pylint: disable=broad-except
+        step.error = error
+    if step.timed_out or step.error is not None:
+        kill_process_group(process.pid)
+        await process.wait()
+    if project_run is not None:
+        project_run.remove_process_group(process.pid)
+        if project_run.cancelled is not None:
+            step.error = "cancelled, the project " + project_run.cancelled
+    step.returncode = process.returncode
+    step.duration = time.monotonic() - started
+    logging.info("%s took %.1f seconds", " ".join(argv), step.duration)
+    return step
+
+
+class ProjectRun:
+
+    """Runs the updater for a single project in a daemon thread. A project
+    that timed out is cancelled: the process groups of its compose commands
+    are killed and further compose commands fail, so that the updater reports
+    the failure and the thread finishes."""
+
+    def __init__(self, path, target, finished):
+        self.path = path
+        self.target = target
+        self.finished = finished
+        self.error = None
+        self.started = None
+        self.cancelled = None
+        self.cancelled_at = None
+        self.process_groups = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name=path, daemon=True)
+
+    def start(self):
+        """Start the thread
+        :returns: None
+
+        """
+        self.started = time.monotonic()
+        self.thread.start()
+
+    def run(self):
+        """Run the target and record any failure, including sys.exit
+        :returns: None
+
+        """
+        CURRENT_PROJECT_RUN.value = self
+        try:
+            self.target(self.path)
+        except SystemExit as error:
+            if error.code:
+                self.error = f"exited with code {error.code}"
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception("Updater for %s failed", self.path)
+            self.error = f"{type(error).__name__}: {error}"
+        finally:
+            self.finished.put(self)
+
+    def add_process_group(self, pid):
+        """Track the process group of a compose command, it is killed at once
+        if the project was already cancelled
+        :returns: None
+
+        """
+        with self.lock:
+            if self.cancelled is None:
+                self.process_groups.add(pid)
+                return
+        kill_process_group(pid)
+
+    def remove_process_group(self, pid):
+        """Stop tracking the process group of a finished compose command
+        :returns: None
+
+        """
+        with self.lock:
+            self.process_groups.discard(pid)
+
+    def cancel(self, reason):
+        """Cancel the project and kill its running compose commands
+
+        :reason: Description of the timeout
+        :returns: None
+
+        """
+        with self.lock:
+            self.cancelled = reason
+            self.cancelled_at = time.monotonic()
+            process_groups = list(self.process_groups)
+        for pid in process_groups:
+            kill_process_group(pid)
+
+
+def kill_process_group(pid):
+    """Kill the process group of the given process
+    :returns: None
+
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_projects(
+    paths, target, workers, timeout, deadline=None, grace=60
+):  # pylint: disable=too-many-arguments
+    """Run the target for every path in a bounded pool of worker threads. The
+    failure or timeout of one project does not affect the others. Projects
+    that time out are cancelled and count as finished once their thread
+    stopped.
+
+    :paths: list of project paths in the order they should be processed
+    :target: function called with the project path
+    :workers: maximum number of projects running at the same time
+    :timeout: wall-clock timeout per project in seconds
+    :deadline: time.monotonic() after which no projects are started and
+    running ones time out, projects that were not started are left out of the
+    results
+    :grace: seconds a cancelled project gets to finish before its thread is
+    abandoned
+    :returns: dict of path and result, None if successful, otherwise a
+    description of the failure
+
+    """
+    pending = list(paths)
+    running = []
+    results = {}
+    finished = queue.Queue()
+
+    def get_project_deadline(project_run):
+        if project_run.cancelled is not None:
+            return project_run.cancelled_at + grace
+        project_deadline = project_run.started + timeout
+        if deadline is not None:
+            project_deadline = min(project_deadline, deadline)
+        return project_deadline
+
+    while pending or running:
+        if deadline is not None and time.monotonic() >= deadline:
+            pending = []
+        while pending and len(running) < workers:
+            project_run = ProjectRun(pending.pop(0), target, finished)
+            project_run.start()
+            running.append(project_run)
+        if not running:
+            break
+        try:
+            project_run = finished.get(
+                timeout=max(
+                    min(map(get_project_deadline, running)) - time.monotonic(), 0
+                )
+            )
+            # Abandoned projects are not running anymore
+            if project_run in running:
+                running.remove(project_run)
+                results[project_run.path] = project_run.cancelled or project_run.error
+        except queue.Empty:
+            pass
+        for project_run in list(running):
+            if time.monotonic() < get_project_deadline(project_run):
+                continue
+            if project_run.cancelled is not None:
+                logging.error(
+                    "Updater for %s did not stop within %s seconds, abandoning it",
+                    project_run.path,
+                    grace,
+                )
+                running.remove(project_run)
+                results[project_run.path] = project_run.cancelled
+                continue
+            if time.monotonic() - project_run.started >= timeout:
+                error = f"timed out after {timeout} seconds"
+            else:
+                error = "timed out at the deadline of the run"
+            logging.error("Updater for %s %s, cancelling it", project_run.path, error)
+            project_run.cancel(error)
+    return results
+
+
+def get_run_summary(results, deferred=()):
+    """Build a summary of a recursive run
+
+    :results: dict of path and result as returned by run_projects
+    :deferred: list of projects deferred to the next run
+    :returns: summary text
+
+    """
+    failed = {path: error for path, error in results.items() if error is not None}
+    text = (
+        f"Processed {len(results)} projects on {get_hostname()}, "
+        + f"{len(results) - len(failed)} succeeded, {len(failed)} failed, "
+        + f"{len(deferred)} deferred to the next run.\n"
+    )
+    if failed:
+        text = text + "\nThe following projects failed:\n\n"
+        for path, error in sorted(failed.items()):
+            text = text + path + ":\n  " + error + "\n"
+    return text
+
+
+def order_projects(paths, last_runs, parse_cache):
+    """Order projects by their priority and the time since their last run, so
+    that projects deferred by a deadline are processed first in the next run
+
+    :paths: list of project paths
+    :last_runs: dict of path and time of the last successful run
+    :parse_cache: ParseCache the priorities are read through
+    :returns: ordered list of paths
+
+    """
+    now = time.time()
+
+    def staleness(path):
+        try:
+            with open(os.path.join(path, "docker-compose.yml"), "rb") as stream:
+                docker_compose_content = stream.read()
+            with open(
+                os.path.join(path, "docker-compose-versions.yml"), "rb"
+            ) as stream:
+                docker_compose_versions_content = stream.read()
+            _, docker_compose_versions = parse_cache.load(
+                path, docker_compose_content, docker_compose_versions_content
+            )
+            priority = (docker_compose_versions or {}).get("priority", "normal")
+        except (OSError, yaml.YAMLError, AttributeError):
+            priority = "normal"
+        # Projects that never ran are the most stale ones
+        waiting = now - last_runs.get(path, 0)
+        return waiting / get_priority_factor(priority)
+
+    return sorted(paths, key=staleness, reverse=True)
+
+
+class RunLock:
+
+    """Lock that prevents overlapping runs. The lock is an flock on the lock
+    file held for the life of the process, so it is released by the kernel if
+    the process dies. The lock file contains the host, pid and start time of
+    the run holding it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = None
+
+    def acquire(self, wait=0):
+        """Acquire the lock
+
+        :wait: seconds to wait for a running process to release the lock
+        :returns: True if the lock was acquired
+
+        """
+        deadline = time.monotonic() + wait
+        # The file stays open while the lock is held
+        stream = open(self.path, "a")  # pylint: disable=consider-using-with
+        while True:
+            try:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    stream.close()
+                    return False
+                time.sleep(1)
+        stream.truncate(0)
+        json.dump(
+            {"host": socket.gethostname(), "pid": os.getpid(), "started": time.time()},
+            stream,
+        )
+        stream.flush()
+        self.stream = stream
+        return True
+
+    def release(self):
+        """Release the lock if it is held by this process. The lock file is
+        kept, as removing it would allow two processes to lock different files
+        :returns: None
+
+        """
+        if self.stream is None:
+            return
+        fcntl.flock(self.stream, fcntl.LOCK_UN)
+        self.stream.close()
+        self.stream = None
+
+
+def run_updates(args, tag_cache):
+    """Run the updater for the path given in the commandline arguments
+
+    :args: namespace with parsed commandline arguments
+    :tag_cache: TagCache shared by all projects
+    :returns: None
+
+    """
+    start = time.monotonic()
+    scheduler = None
+    if args.schedule:
+        scheduler = PollScheduler(get_shard_state_path("schedule.json", args.shard))
+        if scheduler.path is None:
+            logging.warning("STATE_DIR is not set, the schedule is not persisted")
+    parse_cache = ParseCache(get_shard_state_path("parse-cache.json", args.shard))
+    # One snapshot of the running containers is shared by all projects
+    running_state = get_running_state()
+
+    # If recursive option is not given just run the updater for the given path
+    if not args.recursive:
+        updater = Updater(
+            os.path.abspath(args.path),
+            args.dryrun,
+            running_state,
+            tag_cache,
+            scheduler,
+            parse_cache,
+            args.rollout_timeout,
+            args.compose_timeout,
+            args.keep_images,
+        )
+        updater.run()
+        parse_cache.save()
+        if scheduler is not None:
+            scheduler.save()
+        sys.exit(0)
+    # If the recursive option is given, recursiveley search for
+    # docker-compose-versions.yml and run the updater for each found path
+    pathlist = list(get_docker_compose_directories(args.path))
+    if not pathlist:
+        text = "No docker-compose-versions.yml files where found in the given path"
+        logging.warning(text)
+        error_mail(text)
+    pathlist = filter_shard(pathlist, args.path, args.shard)
+
+    def run_updater(path):
+        logging.info("Found docker-compose-versions.yml in %s. Starting updater.", path)
+        Updater(
+            path,
+            args.dryrun,
+            running_state,
+            tag_cache,
+            scheduler,
+            parse_cache,
+            args.rollout_timeout,
+            args.compose_timeout,
+            args.keep_images,
+        ).run()
+
+    deadline = None
+    if args.deadline is not None:
+        deadline = start + args.deadline
+    last_runs_path = get_shard_state_path("last-runs.json", args.shard)
+    last_runs = load_json_state(last_runs_path, {})
+    paths = [os.path.abspath(path) for path in pathlist]
+    if deadline is not None:
+        # Projects deferred by the last deadline go first
+        paths = order_projects(paths, last_runs, parse_cache)
+    results = run_projects(paths, run_updater, args.workers, args.timeout, deadline)
+    parse_cache.save()
+    if scheduler is not None:
+        scheduler.save()
+    for path, error in results.items():
+        # Failed and cancelled projects keep their place in the queue
+        if error is None:
+            last_runs[path] = time.time()
+    if last_runs_path is not None:
+        save_json_state(last_runs_path, last_runs)
+    report_results(results, paths, args.dryrun)
+
+
+def filter_shard(paths, base_path, shard):
+    """Keep the projects belonging to the given shard
+
+    :paths: list of project paths
+    :base_path: Path the projects where searched in
+    :shard: Shard or None to keep all projects
+    :returns: list of project paths
+
+    """
+    if shard is None:
+        return paths
+    # Relative paths keep the partition stable across mount points
+    paths = [path for path in paths if shard.owns(os.path.relpath(path, base_path))]
+    logging.info(
+        "Shard %s/%s processes %s projects", shard.index, shard.count, len(paths)
+    )
+    return paths
+
+
+def report_results(results, paths, dryrun):
+    """Log the summary of a recursive run and send it if projects failed
+
+    :results: dict of path and result as returned by run_projects
+    :paths: list of all project paths of the run
+    :dryrun: True to skip sending the mail
+    :returns: None
+
+    """
+    deferred = [path for path in paths if path not in results]
+    summary = get_run_summary(results, deferred)
+    logging.info(summary)
+    if any(error is not None for error in results.values()) and not dryrun:
+        write_email(
+            summary,
+            "[Dockerupdate][" + get_hostname() + "] Failed projects",
+        )
+
+
+def write_plan(args):
+    """Search for updates of the projects given in the commandline arguments
+    in the cached tags only and write the planned changes
+
+    :args: namespace with parsed commandline arguments
+    :returns: None
+
+    """
+    if args.tag_snapshot is not None:
+        tag_cache = load_tag_snapshot(args.tag_snapshot)
+    else:
+        tag_cache = TagCache(get_state_path("tag-cache"), offline=True)
+    parse_cache = ParseCache(get_shard_state_path("parse-cache.json", args.shard))
+    paths = [args.path]
+    if args.recursive:
+        paths = filter_shard(
+            list(get_docker_compose_directories(args.path)), args.path, args.shard
+        )
+    projects = []
+    for path in paths:
+        try:
+            project = Updater(
+                os.path.abspath(path),
+                True,
+                tag_cache=tag_cache,
+                parse_cache=parse_cache,
+            ).plan()
+        except SystemExit:
+            # A broken project must not stop planning the others
+            logging.error("Cannot plan the updates of %s", path)
+            continue
+        if project is None:
+            continue
+        for entry in project["files"]:
+            logging.info("Planned changes to %s:\n%s", entry["path"], entry["diff"])
+        projects.append(project)
+    parse_cache.save()
+    plan = {"host": get_hostname(), "created": time.time(), "projects": projects}
+    if args.plan == "-":
+        json.dump(plan, sys.stdout, indent=2)
+    else:
+        save_json_state(args.plan, plan)
+    logging.info("Planned updates for %s of %s projects", len(projects), len(paths))
+
+
+def apply_plan(args):
+    """Apply the plan given in the commandline arguments to its projects
+
+    :args: namespace with parsed commandline arguments
+    :returns: None
+
+    """
+    with open(args.apply_plan, "r") as stream:
+        plan = json.load(stream)
+    if plan["host"] != get_hostname():
+        logging.warning("The plan was created on %s", plan["host"])
+    projects = {project["path"]: project for project in plan["projects"]}
+
+    def apply_project(path):
+        logging.info("Applying the plan for %s", path)
+        Updater(
+            path,
+            args.dryrun,
+            rollout_timeout=args.rollout_timeout,
+            compose_timeout=args.compose_timeout,
+            keep_images=args.keep_images,
+        ).apply(projects[path])
+
+    deadline = None
+    if args.deadline is not None:
+        deadline = time.monotonic() + args.deadline
+    paths = list(projects)
+    results = run_projects(paths, apply_project, args.workers, args.timeout, deadline)
+    report_results(results, paths, args.dryrun)
+
+
 def main():
     """Entrypoint when used as an executable
     :returns: None
@@ -591,26 +3046,34 @@ def main():
         initialize_logging()
         # Get Commandline Arguments
         args = get_commandline_arguments()
-
-        # If recursive option is not given just run the updater for the given path
-        if not args.recursive:
-            updater = Updater(os.path.abspath(args.path), args.dryrun)
-            updater.run()
+        if args.plan is not None:
+            # Planning only reads local files and needs no run lock
+            write_plan(args)
             sys.exit(0)
-        # If the recursive option is given, recursiveley search for
-        # docker-compose-versions.yml and run the updater for each found path
-        pathlist = list(get_docker_compose_directories(args.path))
-        if not pathlist:
-            text = "No docker-compose-versions.yml files where found in the given path"
-            logging.warning(text)
-            error_mail(text)
-        for path in pathlist:
-            abspath = os.path.abspath(path)
-            logging.info(
-                "Found docker-compose-versions.yml in %s. Starting updater.", abspath
+        if args.serve_tag_cache is not None:
+            # The served cache fetches from dockerhub directly, TAG_CACHE_URL
+            # may point to this server itself
+            serve_tag_cache(
+                args.serve_tag_cache,
+                TagCache(get_state_path("tag-cache"), fetch=fetch_dockerhub_tags),
             )
-            updater = Updater(abspath, args.dryrun)
-            updater.run()
+            sys.exit(0)
+        tag_cache = TagCache(get_state_path("tag-cache"), shard=args.shard)
+        lock_path = get_shard_state_path("run.lock", args.shard) or os.path.join(
+            tempfile.gettempdir(),
+            get_shard_state_name("docker-compose-update.lock", args.shard),
+        )
+        run_lock = RunLock(lock_path)
+        if not run_lock.acquire(args.wait_lock):
+            logging.info("Another run holds the lock %s, exiting", lock_path)
+            sys.exit(0)
+        try:
+            if args.apply_plan is not None:
+                apply_plan(args)
+            else:
+                run_updates(args, tag_cache)
+        finally:
+            run_lock.release()
     except Exception:
         # If something goes wrong try sending an E-Mail
         logging.critical("An unhandled error occured, sending a mail about the error")
@@ -0,0 +1,80 @@
+"""
+Benchmark reading large docker-compose.yml files with the pure Python YAML
+loader, the libyaml loader and the parse cache.
+
+Run with: python -m src.test.benchmark_read
+"""
+import tempfile
+import timeit
+import os
+from unittest import mock
+import yaml
+from src.docker_compose_update import Updater
+from src.docker_compose_update import ParseCache
+
+
+def write_project(path, services):
+    """Write a docker-compose.yml with the given number of services and a
+    matching docker-compose-versions.yml
+    :returns: None
+
+    """
+    with open(os.path.join(path, "docker-compose.yml"), "w") as stream:
+        stream.write("version: '3.7'\n\nservices:\n")
+        for i in range(services):
+            stream.write(
+                f"  service{i}:\n"
+                + f"    image: python:3.8.{i}-buster\n"
+                + "    restart: unless-stopped\n"
+                + "    environment:\n"
+                + "".join(f"      - VARIABLE_{j}=value{j}\n" for j in range(20))
+                + "    volumes:\n"
+                + "".join(f"      - ./data{j}:/data{j}\n" for j in range(10))
+                + "    labels:\n"
+                + "".join(f"      label.{j}: value{j}\n" for j in range(10))
+            )
+    with open(os.path.join(path, "docker-compose-versions.yml"), "w") as stream:
+        stream.write("auto_update:\n")
+        for i in range(services):
+            stream.write(f"  service{i}: 3\\.8\\.[0-9]+-buster\n")
+
+
+def benchmark(path, loader, parse_cache, number):
+    """Time Updater.read() with the given loader and parse cache
+    :returns: seconds per read
+
+    """
+    with mock.patch("src.docker_compose_update.YAML_LOADER", loader):
+        seconds = timeit.timeit(
+            lambda: Updater(path, True, parse_cache=parse_cache()).read(),
+            number=number,
+        )
+    return seconds / number
+
+
+def main():
+    """Run the benchmark
+    :returns: None
+
+    """
+    loaders = [("pure Python SafeLoader", yaml.SafeLoader)]
+    if hasattr(yaml, "CSafeLoader"):
+        loaders.append(("libyaml CSafeLoader", yaml.CSafeLoader))
+    else:
+        print("libyaml is not available, skipping CSafeLoader")
+    cache = ParseCache()
+    for services in (10, 100, 500):
+        with tempfile.TemporaryDirectory() as path:
+            write_project(path, services)
+            print(f"{services} services:")
+            for name, loader in loaders:
+                seconds = benchmark(path, loader, ParseCache, 5)
+                print(f"  {name}: {seconds * 1000:.2f} ms")
+            # Fill the cache once, afterwards only the file hashes are computed
+            Updater(path, True, parse_cache=cache).read()
+            seconds = benchmark(path, loaders[-1][1], lambda: cache, 20)
+            print(f"  parse cache hit: {seconds * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
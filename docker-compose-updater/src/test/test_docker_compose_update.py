@@ -3,7 +3,14 @@ Test the docker-compose-updater
 """
 import shutil
 import os
+import sys
 import subprocess
+import threading
+import json
+import argparse
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer
 from unittest import mock
 import pytest
 import requests
@@ -11,6 +18,33 @@ from src.docker_compose_update import Updater
 from src.docker_compose_update import Service
 from src.docker_compose_update import initialize_logging
 from src.docker_compose_update import get_docker_compose_directories
+from src.docker_compose_update import RunningState
+from src.docker_compose_update import normalize_image_reference
+from src.docker_compose_update import TagCache
+from src.docker_compose_update import TagCacheRequestHandler
+from src.docker_compose_update import fetch_tags
+from src.docker_compose_update import parse_image_ttls
+from src.docker_compose_update import VersionIndex
+from src.docker_compose_update import PollScheduler
+from src.docker_compose_update import get_release_interval
+from src.docker_compose_update import run_projects
+from src.docker_compose_update import get_run_summary
+from src.docker_compose_update import ParseCache
+from src.docker_compose_update import load_yaml
+from src.docker_compose_update import load_json_state
+from src.docker_compose_update import wait_for_health
+from src.docker_compose_update import RunLock
+from src.docker_compose_update import order_projects
+from src.docker_compose_update import ComposeStep
+from src.docker_compose_update import run_compose
+from src.docker_compose_update import prune_images
+from src.docker_compose_update import DockerEngineError
+from src.docker_compose_update import Shard
+from src.docker_compose_update import main
+from src.docker_compose_update import run_updates
+from src.docker_compose_update import load_tag_snapshot
+from src.docker_compose_update import get_pull_size
+from src.docker_compose_update import PlanError
 
 
 # pylint: disable=missing-function-docstring,no-self-use
@@ -122,7 +156,7 @@ class TestDockerComposeUpdate:  # pylint: disable=missing-class-docstring
         path = os.path.join("./src/test/example_services_test_run/", path)
         updater = Updater(path, dryrun)
         with mock.patch(
-            "src.docker_compose_update.subprocess"
+            "src.docker_compose_update.run_compose", side_effect=compose_step
         ) as subprocess_mock, mock.patch(
             "src.docker_compose_update.write_email"
         ), mock.patch(
@@ -133,7 +167,7 @@ class TestDockerComposeUpdate:  # pylint: disable=missing-class-docstring
             )
 
             updater.run()
-            assert subprocess_mock.run.called == dc_run
+            assert subprocess_mock.called == dc_run
         docker_compose_path = os.path.join(path, "docker-compose.yml")
         with open(docker_compose_path) as docker_compose_file:
             docker_compose = docker_compose_file.readlines()
@@ -150,14 +184,20 @@ class TestDockerComposeUpdate:  # pylint: disable=missing-class-docstring
     ):  # pylint: disable=unused-argument
         updater = Updater("./src/test/example_services_test_run/", False)
         with mock.patch(
-            "src.docker_compose_update.subprocess.run"
-        ) as subprocess_run, mock.patch("src.docker_compose_update.write_email"):
-            subprocess_run.side_effect = subprocess.CalledProcessError(2, "testcommand")
+            "src.docker_compose_update.run_compose"
+        ) as subprocess_run, mock.patch(
+            "src.docker_compose_update.write_email"
+        ) as write_email:
+            subprocess_run.side_effect = lambda args, cwd, timeout: compose_step(
+                args, cwd, timeout, 2
+            )
             updater.build()
             assert subprocess_run.called
+            assert write_email.called
             subprocess_run.reset_mock()
             updater.up()
             assert subprocess_run.called
+            assert "exited with code 2" in updater.get_step_report()
 
     def test_read_not_found(self, example_services):  # pylint: disable=unused-argument
         updater = Updater("./src/test/example_services_test_run/", False)
@@ -261,6 +301,871 @@ class TestDockerComposeUpdate:  # pylint: disable=missing-class-docstring
         ]:
             assert test_directory not in directory_list
 
+    @pytest.mark.parametrize(
+        "image, containers, drift",
+        [
+            ("python:3.8.2-buster", [("python:3.8.2-buster", "sha256:new")], None),
+            (
+                "docker.io/library/python:3.8.2-buster",
+                [("python:3.8.2-buster", "sha256:new")],
+                None,
+            ),
+            ("python:3.8.2-buster", [("sha256:new", "sha256:new")], None),
+            (
+                "python:3.8.2-buster",
+                [("python:3.7.6-buster", "sha256:old")],
+                "running python:3.7.6-buster instead of python:3.8.2-buster",
+            ),
+            (
+                "python:3.8.2-buster",
+                [("python:3.8.2-buster", "sha256:old")],
+                "running an outdated digest of python:3.8.2-buster",
+            ),
+            (
+                "python:3.9.0-buster",
+                [("python:3.8.2-buster", "sha256:new")],
+                "pinned image python:3.9.0-buster is not available locally",
+            ),
+            ("python:3.8.2-buster", [], "no running container"),
+            (None, [("dummy-dummy", "sha256:built")], None),
+        ],
+    )
+    def test_running_state_drift(self, image, containers, drift):
+        running_state = RunningState(
+            [
+                {
+                    "Image": running_image,
+                    "ImageID": image_id,
+                    "Labels": {
+                        RunningState.working_dir_label: "/srv/project/",
+                        RunningState.service_label: "dummy",
+                    },
+                }
+                for running_image, image_id in containers
+            ],
+            [
+                {"Id": "sha256:new", "RepoTags": ["python:3.8.2-buster"]},
+                {"Id": "sha256:old", "RepoTags": ["python:3.7.6-buster"]},
+            ],
+        )
+        assert running_state.get_drift("/srv/project", "dummy", image) == drift
+
+    def test_normalize_image_reference(self):
+        assert normalize_image_reference("python") == "python:latest"
+        assert normalize_image_reference("library/python:3") == "python:3"
+        assert (
+            normalize_image_reference("registry.example.com:5000/app")
+            == "registry.example.com:5000/app:latest"
+        )
+
+    @pytest.mark.parametrize("converged", [True, False])
+    def test_run_skips_up_when_converged(
+        self, example_services, converged
+    ):  # pylint: disable=unused-argument
+        path = os.path.abspath("./src/test/example_services_test_run/base")
+        running_image = "python:3.8.2-buster" if converged else "python:latest"
+        running_state = RunningState(
+            [
+                {
+                    "Image": running_image,
+                    "ImageID": "sha256:" + running_image,
+                    "Labels": {
+                        RunningState.working_dir_label: path,
+                        RunningState.service_label: "dummy",
+                    },
+                }
+            ],
+            [
+                {"Id": "sha256:" + running_image, "RepoTags": [running_image]},
+            ],
+        )
+        updater = Updater(path, False, running_state)
+        with mock.patch(
+            "src.docker_compose_update.run_compose", side_effect=compose_step
+        ) as subprocess_mock, mock.patch(
+            "src.docker_compose_update.write_email"
+        ), mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock, mock.patch(
+            "src.docker_compose_update.load_yaml", side_effect=load_yaml
+        ) as load_yaml_mock:
+            request_mock.get = mock.Mock(side_effect=request_dockerhub(200))
+            updater.run()
+            assert subprocess_mock.called != converged
+            # Checking the drift does not parse the docker-compose.yml again
+            assert load_yaml_mock.call_count == 2
+
+    @pytest.mark.parametrize("drifted", [True, False, None])
+    def test_run_reconciles_drift(
+        self, example_services, drifted
+    ):  # pylint: disable=unused-argument
+        """drifted is None for a managed service that was stopped"""
+        path = os.path.abspath("./src/test/example_services_test_run/up_to_date")
+        # Unmanaged services without a running container are ignored
+        with open(os.path.join(path, "docker-compose.yml"), "a") as stream:
+            stream.write("  oneshot:\n    image: busybox\n")
+        running_image = "python:3.7.6-buster" if drifted else "python:3.8.2-buster"
+        running_state = RunningState(
+            [
+                {
+                    "Image": running_image,
+                    "ImageID": "sha256:" + running_image,
+                    "Labels": {
+                        RunningState.working_dir_label: path,
+                        RunningState.service_label: "dummy",
+                    },
+                }
+            ]
+            if drifted is not None
+            else [],
+            [
+                {"Id": "sha256:" + image, "RepoTags": [image]}
+                for image in ("python:3.7.6-buster", "python:3.8.2-buster")
+            ],
+        )
+        updater = Updater(path, False, running_state)
+        with mock.patch(
+            "src.docker_compose_update.run_compose", side_effect=compose_step
+        ) as subprocess_mock, mock.patch(
+            "src.docker_compose_update.write_email"
+        ) as write_email, mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock:
+            request_mock.get = mock.Mock(side_effect=request_dockerhub(200))
+            updater.run()
+            argvs = [call[0][0] for call in subprocess_mock.call_args_list]
+        if drifted:
+            assert argvs == [("up", "-d", "dummy")]
+            assert "running python:3.7.6-buster" in write_email.call_args[0][0]
+        else:
+            assert not argvs
+            assert not write_email.called
+
+    def test_tag_cache_coalesces_requests(self, tmp_path):
+        fetched = []
+
+        def fetch(image):
+            fetched.append(image)
+            time.sleep(0.1)
+            return [{"name": "3.8.2-buster", "images": []}]
+
+        path = str(tmp_path / "tag-cache")
+        tag_cache = TagCache(path, ttl=3600, image_ttls={"node": 0}, fetch=fetch)
+        threads = [
+            threading.Thread(target=tag_cache.get, args=("python",)) for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert fetched == ["python"]
+        tag_cache.get("node")
+        tag_cache.get("node")
+        assert fetched == ["python", "node", "node"]
+        # Every image is persisted in its own file and used by the next run
+        assert sorted(os.listdir(path)) == ["node.json", "python.json"]
+        assert TagCache(path, ttl=3600, image_ttls={}, fetch=fetch).get("python")
+        assert fetched == ["python", "node", "node"]
+
+    def test_tag_cache_server(self):
+        tags = [{"name": "3.8.2-buster", "images": []}]
+        TagCacheRequestHandler.tag_cache = TagCache(
+            ttl=3600,
+            image_ttls={},
+            fetch=lambda image: tags if image == "library/python" else None,
+        )
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), TagCacheRequestHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        url = "http://127.0.0.1:" + str(httpd.server_address[1])
+        try:
+            with mock.patch.dict(os.environ, {"TAG_CACHE_URL": url}):
+                assert fetch_tags("library/python") == tags
+                assert fetch_tags("unknown") is None
+        finally:
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+
+    def test_serve_tag_cache_fetches_from_dockerhub(self):
+        with mock.patch.dict(
+            os.environ, {"TAG_CACHE_URL": "http://127.0.0.1:1"}
+        ), mock.patch.object(
+            sys, "argv", ["update", "--serve-tag-cache", "0"]
+        ), mock.patch(
+            "src.docker_compose_update.serve_tag_cache"
+        ) as serve_tag_cache, mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock:
+            request_mock.get = mock.Mock(side_effect=request_dockerhub(200))
+            with pytest.raises(SystemExit):
+                main()
+            tag_cache = serve_tag_cache.call_args[0][1]
+            assert tag_cache.get("python")
+            # The server does not request the tags from itself
+            urls = [call[0][0] for call in request_mock.get.call_args_list]
+            assert urls[0].startswith("https://registry.hub.docker.com/")
+
+    def test_tag_cache_server_unreachable(self):
+        with mock.patch.dict(
+            os.environ, {"TAG_CACHE_URL": "http://127.0.0.1:1"}
+        ), mock.patch(
+            "src.docker_compose_update.fetch_dockerhub_tags"
+        ) as fetch_dockerhub_tags:
+            fetch_dockerhub_tags.return_value = []
+            assert fetch_tags("python") == []
+            assert fetch_dockerhub_tags.called
+
+    def test_parse_image_ttls(self):
+        assert parse_image_ttls("") == {}
+        assert parse_image_ttls("node=300, library/python=60") == {
+            "node": 300,
+            "library/python": 60,
+        }
+
+    def test_version_index(self):
+        index = VersionIndex.from_tags(
+            [
+                {"name": name}
+                for name in [
+                    "latest",
+                    "3.10.1-buster",
+                    "3.8.2-buster",
+                    "3.8.10-buster",
+                    "3.8.2",
+                    "2.7.18-buster",
+                    "3.8.2-alpine",
+                ]
+            ]
+        )
+        assert VersionIndex.parse("3.8.2-slim-buster") == ((3, 8, 2), "slim-buster")
+        assert VersionIndex.parse("latest") is None
+        assert index.find("buster") == "3.10.1-buster"
+        assert index.find("buster", (3, 8), (3, 9)) == "3.8.10-buster"
+        assert index.find("buster", None, (3,)) == "2.7.18-buster"
+        assert index.find("", (3,)) == "3.8.2"
+        assert index.find("alpine", (3, 9)) is None
+        assert (
+            index.find("buster", accept=lambda name: not name.startswith("3.10"))
+            == "3.8.10-buster"
+        )
+        assert VersionIndex.from_dict(index.to_dict()).find("buster") == "3.10.1-buster"
+
+    @pytest.mark.parametrize(
+        "current_version, constraints, next_version",
+        [
+            ("3.7.6-buster", {"policy": "patch"}, "3.7.6-buster"),
+            ("3.7.6-buster", {"policy": "minor"}, "3.8.2-buster"),
+            ("3.7-buster", {"policy": "minor"}, "3.8.2-buster"),
+            ("3.7.6-buster", {"range": ">=3.7,<3.8"}, "3.7.6-buster"),
+            ("3.7.6-buster", {"range": "~=3.8.0"}, "3.8.2-buster"),
+            ("3.7.6-buster", {"regex": "^3\\.[0-9]+-"}, "3.8-buster"),
+            ("latest", {"variant": "buster"}, "3.8.2-buster"),
+            ("latest", {}, "3"),
+            ("3.7.6-buster", {"policy": "dummy"}, "3.7.6-buster"),
+            ("3.7.6-buster", {"range": "dummy"}, "3.7.6-buster"),
+        ],
+    )
+    def test_find_constrained_version(self, current_version, constraints, next_version):
+        service = Service("python", constraints, current_version, "")
+        with mock.patch("src.docker_compose_update.write_email"), mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock:
+            request_mock.get = mock.Mock(side_effect=request_dockerhub(200))
+            service.find_next_version()
+        assert service.next_version == next_version
+
+    def test_get_release_interval(self):
+        tags = [
+            {"name": "1", "last_updated": "2023-01-01T00:00:00.000000Z"},
+            {"name": "2", "last_updated": "2023-01-03T00:00:00.000000Z"},
+            {"name": "3", "last_updated": "2023-01-04T00:00:00.000000Z"},
+            {"name": "4", "last_updated": None},
+        ]
+        assert get_release_interval(tags) == 1.5 * 24 * 60 * 60
+        assert get_release_interval(tags[:1]) is None
+        assert get_release_interval(None) is None
+
+    def test_poll_scheduler(self, tmp_path):
+        path = str(tmp_path / "schedule.json")
+        scheduler = PollScheduler(path)
+        assert scheduler.is_due("python")
+        scheduler.record("python", None, "normal")
+        # Images checked in this run stay due
+        assert scheduler.is_due("python")
+        # The schedule is persisted once per run
+        assert not os.path.exists(path)
+        scheduler.save()
+        scheduler = PollScheduler(path)
+        assert not scheduler.is_due("python")
+        assert scheduler.state["python"]["interval"] == PollScheduler.default_interval
+        assert scheduler.get_interval(None, "high") < scheduler.get_interval(None)
+        assert scheduler.get_interval(None, "low") > scheduler.get_interval(None)
+        with mock.patch.dict(
+            "src.docker_compose_update.DOCKERHUB_RATE_LIMIT",
+            {"limit": 100, "remaining": 25},
+        ):
+            assert scheduler.get_interval(None) == 2 * PollScheduler.default_interval
+
+    def test_run_skips_images_not_due(
+        self, example_services
+    ):  # pylint: disable=unused-argument
+        path = "./src/test/example_services_test_run/base"
+        scheduler = PollScheduler()
+        scheduler.state["python"] = {"next_check": time.time() + 60, "interval": 60}
+        updater = Updater(path, False, scheduler=scheduler)
+        with mock.patch(
+            "src.docker_compose_update.run_compose", side_effect=compose_step
+        ) as subprocess_mock, mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock:
+            updater.run()
+            assert not request_mock.get.called
+            assert not subprocess_mock.called
+
+    def test_run_projects(self):
+        running = []
+        max_running = []
+        hang = threading.Event()
+
+        def target(path):
+            running.append(path)
+            max_running.append(len(running))
+            try:
+                if path == "hang":
+                    hang.wait(10)
+                elif path == "exit":
+                    sys.exit(1)
+                elif path == "error":
+                    raise ValueError("broken")
+                time.sleep(0.05)
+            finally:
+                running.remove(path)
+
+        paths = ["ok1", "hang", "exit", "error", "ok2", "ok3"]
+        results = run_projects(paths, target, 2, 0.5, grace=0.2)
+        hang.set()
+        assert max(max_running) <= 2
+        assert results == {
+            "ok1": None,
+            "ok2": None,
+            "ok3": None,
+            "hang": "timed out after 0.5 seconds",
+            "exit": "exited with code 1",
+            "error": "ValueError: broken",
+        }
+        summary = get_run_summary(results)
+        assert "6 projects" in summary
+        assert "3 failed" in summary
+        assert "error:\n  ValueError: broken\n" in summary
+
+    def test_parse_cache(self, tmp_path):
+        path = str(tmp_path / "parse-cache.json")
+        docker_compose = (
+            b"services:\n  dummy:\n    image: python:latest\n    ports: [80]\n"
+        )
+        versions = b"auto_update:\n  dummy: 3\\.[0-9]+\n"
+        parse_cache = ParseCache(path)
+        expected = (
+            {"services": {"dummy": {"image": "python:latest"}}},
+            {"auto_update": {"dummy": "3\\.[0-9]+"}},
+        )
+        assert parse_cache.load("/project", docker_compose, versions) == expected
+        parse_cache.save()
+        parse_cache = ParseCache(path)
+        with mock.patch("src.docker_compose_update.load_yaml") as load_yaml:
+            assert parse_cache.load("/project", docker_compose, versions) == expected
+            assert not load_yaml.called
+            parse_cache.load("/project", docker_compose, b"{}")
+            assert load_yaml.called
+
+    @pytest.mark.parametrize(
+        "polls, failed",
+        [
+            ([[("running", "Up 1 second")]], {}),
+            (
+                [
+                    [("running", "Up 1 second (health: starting)")],
+                    [("running", "Up 3 seconds (healthy)")],
+                ],
+                {},
+            ),
+            ([[("running", "Up 1 second (unhealthy)")]], {"dummy": "unhealthy"}),
+            ([[("exited", "Exited (1)")]], {"dummy": "exited"}),
+            (
+                [[("running", "Up (healthy)"), ("restarting", "Restarting")]] * 3,
+                {"dummy": "restarting"},
+            ),
+            ([[]] * 3, {"dummy": "missing"}),
+        ],
+    )
+    def test_wait_for_health(self, polls, failed):
+        engine = mock.Mock()
+        engine.request.side_effect = [
+            [
+                {
+                    "State": state,
+                    "Status": status,
+                    "Labels": {RunningState.service_label: "dummy"},
+                }
+                for state, status in poll
+            ]
+            for poll in polls
+        ]
+        assert wait_for_health(engine, "/srv/project", ["dummy"], 0.02, 0.01) == failed
+
+    def test_wait_for_health_ignores_oneoff(self):
+        labels = {
+            RunningState.working_dir_label: "/srv/project",
+            RunningState.service_label: "dummy",
+        }
+        containers = [
+            {
+                "State": "running",
+                "Status": "Up 3 seconds (healthy)",
+                "Labels": dict(labels, **{RunningState.oneoff_label: "False"}),
+            },
+            {
+                "State": "exited",
+                "Status": "Exited (1)",
+                "Labels": dict(labels, **{RunningState.oneoff_label: "True"}),
+            },
+        ]
+
+        def request(method, path):  # pylint: disable=unused-argument
+            # Filter by labels like the Docker Engine
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            filters = json.loads(query["filters"][0])["label"]
+            return [
+                container
+                for container in containers
+                if all(
+                    container["Labels"].get(key) == value
+                    for key, value in (label.split("=", 1) for label in filters)
+                )
+            ]
+
+        engine = mock.Mock()
+        engine.request.side_effect = request
+        assert wait_for_health(engine, "/srv/project", ["dummy"], 0.02, 0.01) == {}
+        # One-off containers are no service containers
+        running_state = RunningState(containers[1:], [])
+        assert (
+            running_state.get_drift("/srv/project", "dummy", None)
+            == RunningState.not_running
+        )
+
+    @pytest.mark.parametrize("healthy", [True, False])
+    def test_run_rollback(
+        self, example_services, healthy
+    ):  # pylint: disable=unused-argument
+        path = "./src/test/example_services_test_run/dockerfile_base"
+        updater = Updater(path, False, rollout_timeout=10)
+        with mock.patch(
+            "src.docker_compose_update.run_compose", side_effect=compose_step
+        ) as subprocess_mock, mock.patch(
+            "src.docker_compose_update.write_email"
+        ) as write_email, mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock, mock.patch(
+            "src.docker_compose_update.wait_for_health"
+        ) as wait_for_health_mock:
+            request_mock.get = mock.Mock(side_effect=request_dockerhub(200))
+            wait_for_health_mock.return_value = {} if healthy else {"dummy": "exited"}
+            updater.run()
+            argvs = [call[0][0] for call in subprocess_mock.call_args_list]
+            mail_text = write_email.call_args[0][0]
+        with open(os.path.join(path, "Dockerfile")) as dockerfile:
+            from_line = dockerfile.readlines()[1]
+        if healthy:
+            assert from_line == "FROM python:3.8.2-buster \n"
+            assert len(argvs) == 2
+            assert "rolled back" not in mail_text
+        else:
+            assert from_line == "FROM python:latest\n"
+            assert argvs[-1][-1] == "dummy"
+            assert len(argvs) == 4
+            assert "Rolled back to: python:latest" in mail_text
+
+    def test_run_projects_cancels_compose(self, tmp_path):
+        steps = []
+
+        def target(path):
+            steps.append(run_compose(["echo $$ > pid; sleep 20"], path))
+            steps.append(run_compose(["touch after"], path))
+
+        with mock.patch.dict(os.environ, {"DOCKER_COMPOSE_COMMAND": "sh -c"}):
+            started = time.monotonic()
+            results = run_projects([str(tmp_path)], target, 1, 0.5)
+        assert time.monotonic() - started < 10
+        assert results == {str(tmp_path): "timed out after 0.5 seconds"}
+        # The compose command was killed and no further commands where run
+        with open(tmp_path / "pid") as stream:
+            with pytest.raises(ProcessLookupError):
+                os.kill(int(stream.read()), 0)
+        assert not os.path.exists(tmp_path / "after")
+        assert [step.get_error() for step in steps] == [
+            "cancelled, the project timed out after 0.5 seconds"
+        ] * 2
+
+    def test_run_projects_deadline(self):
+        results = run_projects(
+            ["slow1", "slow2", "slow3"],
+            lambda path: time.sleep(0.3),
+            1,
+            10,
+            time.monotonic() + 0.1,
+        )
+        assert results == {"slow1": "timed out at the deadline of the run"}
+        assert "2 deferred" in get_run_summary(results, ["slow2", "slow3"])
+
+    def test_order_projects(self, tmp_path):
+        for name, priority in [("low", "low"), ("normal", None), ("high", "high")]:
+            os.mkdir(tmp_path / name)
+            with open(tmp_path / name / "docker-compose-versions.yml", "w") as stream:
+                if priority:
+                    stream.write("priority: " + priority + "\n")
+            with open(tmp_path / name / "docker-compose.yml", "w") as stream:
+                stream.write("services: {}\n")
+        paths = [str(tmp_path / name) for name in ("low", "normal", "high", "new")]
+        now = time.time()
+        last_runs = {paths[0]: now - 3000, paths[1]: now - 1200, paths[2]: now - 60}
+        parse_cache = ParseCache()
+        for _ in range(2):
+            with mock.patch(
+                "src.docker_compose_update.load_yaml", side_effect=load_yaml
+            ) as load_yaml_mock:
+                assert order_projects(paths, last_runs, parse_cache) == [
+                    paths[3],
+                    paths[1],
+                    paths[0],
+                    paths[2],
+                ]
+        # The priorities are read through the parse cache
+        assert not load_yaml_mock.called
+
+    @pytest.mark.parametrize("deadline", [None, 100])
+    def test_run_updates_last_runs(self, tmp_path, deadline):
+        state_dir = tmp_path / "state"
+        os.mkdir(state_dir)
+        paths = []
+        for name in ("done", "cancelled"):
+            os.mkdir(tmp_path / name)
+            (tmp_path / name / "docker-compose-versions.yml").write_text("")
+            paths.append(str(tmp_path / name))
+        args = argparse.Namespace(
+            schedule=False,
+            shard=None,
+            recursive=True,
+            path=str(tmp_path),
+            dryrun=True,
+            rollout_timeout=0,
+            compose_timeout=None,
+            keep_images=0,
+            deadline=deadline,
+            workers=1,
+            timeout=10,
+        )
+        with mock.patch.dict(os.environ, {"STATE_DIR": str(state_dir)}), mock.patch(
+            "src.docker_compose_update.get_running_state"
+        ), mock.patch(
+            "src.docker_compose_update.order_projects", side_effect=order_projects
+        ) as order_mock, mock.patch(
+            "src.docker_compose_update.run_projects"
+        ) as run_projects_mock:
+            run_projects_mock.return_value = {
+                paths[0]: None,
+                paths[1]: "timed out at the deadline of the run",
+            }
+            run_updates(args, TagCache())
+        # Projects are only reordered for runs with a deadline
+        assert order_mock.called == (deadline is not None)
+        with open(state_dir / "last-runs.json") as stream:
+            assert list(json.load(stream)) == [paths[0]]
+
+    def test_run_lock(self, tmp_path):
+        path = str(tmp_path / "run.lock")
+        run_lock = RunLock(path)
+        assert run_lock.acquire()
+        assert not RunLock(path).acquire()
+        with open(path) as stream:
+            assert json.load(stream)["pid"] == os.getpid()
+        run_lock.release()
+        assert RunLock(path).acquire()
+        # Locks of processes that died are released by the kernel
+        path = str(tmp_path / "other.lock")
+        with subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys; sys.path.insert(0, '.');"
+                + "from src.docker_compose_update import RunLock;"
+                + "lock = RunLock(sys.argv[1]); lock.acquire(); print(flush=True);"
+                + "sys.stdin.read()",
+                path,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        ) as process:
+            process.stdout.readline()
+            assert not RunLock(path).acquire(0.5)
+            process.kill()
+        assert RunLock(path).acquire()
+
+    def test_run_compose(self, tmp_path):
+        with mock.patch.dict(os.environ, {"DOCKER_COMPOSE_COMMAND": "sh -c"}):
+            step = run_compose(["pwd; echo error >&2; exit 3"], str(tmp_path))
+            assert step.argv == ["sh", "-c", "pwd; echo error >&2; exit 3"]
+            assert step.returncode == 3
+            assert not step.succeeded
+            assert sorted(step.output) == sorted([str(tmp_path), "error"])
+            # Lines longer than the StreamReader limit are read completely
+            step = run_compose(
+                ["head -c 200000 /dev/zero | tr '\\0' a; echo; echo done"],
+                str(tmp_path),
+            )
+            assert step.succeeded
+            assert [len(line) for line in step.output] == [200000, 4]
+            step = run_compose(["sleep 5"], str(tmp_path), 0.2)
+            assert step.timed_out
+            assert step.duration < 5
+            assert step.get_error() == "timed out after 0 seconds"
+        with mock.patch.dict(os.environ, {"DOCKER_COMPOSE_COMMAND": "/nonexistent"}):
+            step = run_compose(["build"], str(tmp_path))
+            assert not step.succeeded
+            assert "No such file" in step.get_error()
+
+    @pytest.mark.parametrize(
+        "keep, deleted",
+        [(1, ["/images/3", "/images/4"]), (2, ["/images/4"]), (3, [])],
+    )
+    def test_prune_images(self, keep, deleted):
+        engine = mock.Mock()
+        requests_sent = []
+
+        def request(method, path):
+            if method == "GET":
+                return [
+                    {"Id": "0", "RepoTags": ["python:3.9.1-buster"]},
+                    {
+                        "Id": "1",
+                        "RepoTags": ["python:3.8.2-buster", "python:3.8-buster"],
+                    },
+                    {
+                        "Id": "2",
+                        "RepoTags": ["python:3.7.6-buster", "python:3.7-buster"],
+                    },
+                    {"Id": "3", "RepoTags": ["docker.io/library/python:3.6.0-buster"]},
+                    {"Id": "4", "RepoTags": ["python:3.5.0-buster"]},
+                    {"Id": "5", "RepoTags": ["python:3.5.0-alpine", "python:latest"]},
+                    {"Id": "6", "RepoTags": ["pypy:3.5.0-buster"]},
+                    {"Id": "7", "RepoTags": ["python:3.4.0-buster", "app:3.4.0"]},
+                    {"Id": "8", "RepoTags": None},
+                ]
+            requests_sent.append(path)
+            if path == "/images/3":
+                raise DockerEngineError("image is being used by a container")
+            return None
+
+        engine.request.side_effect = request
+        removed = prune_images(engine, {"python": "3.8.2-buster"}, keep)
+        assert requests_sent == deleted
+        assert removed == (["python:3.5.0-buster"] if "/images/4" in deleted else [])
+
+    def test_shard(self):
+        shards = [Shard.parse(f"{index}/3") for index in range(3)]
+        for key in ["base", "up_to_date", "sub/dir", "python", "node"]:
+            assert sum(shard.owns(key) for shard in shards) == 1
+        assert shards[1].get_state_name("run.lock") == "run-1-of-3.lock"
+        for text in ["3/3", "-1/3", "0/0", "1", "a/b"]:
+            with pytest.raises(argparse.ArgumentTypeError):
+                Shard.parse(text)
+
+    def test_tag_cache_shard(self, tmp_path):
+        path = str(tmp_path / "tag-cache")
+        shards = [Shard.parse("0/2"), Shard.parse("1/2")]
+        image = "python"
+        owner = shards[0] if shards[0].owns(image) else shards[1]
+        other = shards[1] if owner is shards[0] else shards[0]
+        fetched = []
+
+        def fetch(image):
+            fetched.append(image)
+            return [{"name": "3.8.2-buster", "images": []}]
+
+        owner_cache = TagCache(path, ttl=10, image_ttls={}, fetch=fetch, shard=owner)
+        other_cache = TagCache(path, ttl=10, image_ttls={}, fetch=fetch, shard=other)
+        owner_cache.get(image)
+        assert fetched == [image]
+        # Stale tags refreshed by the owning shard are used by the other one
+        other_cache.reload(image)
+        other_cache.entries[image]["fetched"] -= 20
+        with mock.patch(
+            "src.docker_compose_update.load_json_state", side_effect=load_json_state
+        ) as load_mock:
+            assert other_cache.get(image)
+        # Only the file of the image is read
+        assert [call[0][0] for call in load_mock.call_args_list] == [
+            os.path.join(path, image + ".json")
+        ]
+        assert fetched == [image]
+        # Unless they are much older than the TTL
+        other_cache.entries[image]["fetched"] -= 100
+        with mock.patch.object(other_cache, "reload"):
+            other_cache.get(image)
+        assert fetched == [image, image]
+
+    @pytest.mark.parametrize(
+        "platforms, next_version",
+        [
+            (None, "3.10.0"),
+            (["linux/amd64", "linux/arm64"], "3.9.0"),
+            ("arm64/v8", "3.9.0"),
+            (["amd64", "arm/v7"], "3.8.0"),
+            (["amd64", "arm/v6"], "3.7.0"),
+        ],
+    )
+    def test_find_next_version_platforms(self, platforms, next_version):
+        tags = [
+            {"name": "3.10.0", "images": [{"architecture": "amd64"}]},
+            {
+                "name": "3.9.0",
+                "images": [
+                    {"architecture": "amd64", "os": "linux"},
+                    {"architecture": "arm64", "os": "linux", "variant": "v8"},
+                ],
+            },
+            {
+                "name": "3.8.0",
+                "images": [
+                    {"architecture": "amd64"},
+                    {"architecture": "arm", "variant": "v7"},
+                ],
+            },
+        ]
+        tag_cache = TagCache(ttl=3600, image_ttls={}, fetch=lambda image: tags)
+        for search_regex in ["^3\\.[0-9]+\\.[0-9]+$", {"policy": "major"}]:
+            service = Service("python", search_regex, "3.7.0", "", tag_cache, platforms)
+            service.find_next_version()
+            assert service.next_version == next_version
+
+    @pytest.mark.parametrize(
+        "path, changed_file, line, content, build",
+        [
+            (
+                "base",
+                "docker-compose.yml",
+                4,
+                "    image: python:3.8.2-buster\n",
+                False,
+            ),
+            ("dockerfile_base", "Dockerfile", 1, "FROM python:3.8.2-buster \n", True),
+        ],
+    )
+    def test_plan_and_apply(
+        self, example_services, tmp_path, path, changed_file, line, content, build
+    ):  # pylint: disable=unused-argument,too-many-arguments
+        path = os.path.abspath(
+            os.path.join("./src/test/example_services_test_run", path)
+        )
+        changed_path = os.path.join(path, changed_file)
+        snapshot_path = str(tmp_path / "tags.json")
+        with open(snapshot_path, "w") as stream:
+            json.dump(
+                {
+                    "python": [
+                        {"name": "latest", "images": [{"architecture": "amd64"}]},
+                        {
+                            "name": "3.8.2-buster",
+                            "images": [
+                                {"architecture": "arm64", "size": 20},
+                                {"architecture": "amd64", "size": 10},
+                            ],
+                        },
+                    ]
+                },
+                stream,
+            )
+        with open(changed_path) as stream:
+            original = stream.read()
+        with mock.patch("src.docker_compose_update.requests") as request_mock:
+            plan = Updater(
+                path, True, tag_cache=load_tag_snapshot(snapshot_path)
+            ).plan()
+            assert not request_mock.get.called
+        with open(changed_path) as stream:
+            assert stream.read() == original
+        assert [entry["path"] for entry in plan["files"]] == [changed_path]
+        assert "+" + content in plan["files"][0]["diff"]
+        assert plan["build"] == build
+        assert plan["restart"] == ["dummy"]
+        assert plan["pull_size"] == 10
+        assert plan["updates"]["auto_update"]["dummy"]["old"] == "latest"
+
+        with mock.patch(
+            "src.docker_compose_update.run_compose", side_effect=compose_step
+        ) as subprocess_mock, mock.patch(
+            "src.docker_compose_update.write_email"
+        ) as write_email, mock.patch(
+            "src.docker_compose_update.requests"
+        ) as request_mock:
+            Updater(path, False).apply(json.loads(json.dumps(plan)))
+            assert not request_mock.get.called
+            argvs = [call[0][0] for call in subprocess_mock.call_args_list]
+            assert "New: 3.8.2-buster" in write_email.call_args[0][0]
+        with open(changed_path) as stream:
+            assert stream.readlines()[line] == content
+        assert argvs == ([("build",)] if build else []) + [("up", "-d", "dummy")]
+
+    def test_apply_changed_plan(
+        self, example_services
+    ):  # pylint: disable=unused-argument
+        path = os.path.abspath("./src/test/example_services_test_run/base")
+        tag_cache = TagCache(offline=True)
+        tag_cache.entries["python"] = {
+            "fetched": 0,
+            "tags": [{"name": "3.8.2-buster", "images": [{"architecture": "amd64"}]}],
+        }
+        plan = Updater(path, True, tag_cache=tag_cache).plan()
+        assert plan["pull_size"] == 0
+        with open(os.path.join(path, "docker-compose.yml"), "a") as stream:
+            stream.write("    restart: always\n")
+        with mock.patch(
+            "src.docker_compose_update.run_compose", side_effect=compose_step
+        ) as subprocess_mock, mock.patch("src.docker_compose_update.write_email"):
+            with pytest.raises(PlanError):
+                Updater(path, False).apply(plan)
+            assert not subprocess_mock.called
+        # Images missing in an offline cache are skipped without a mail
+        with mock.patch("src.docker_compose_update.error_mail") as error_mail:
+            assert Updater(path, True, tag_cache=TagCache(offline=True)).plan() is None
+            assert not error_mail.called
+
+    def test_get_pull_size(self):
+        tags = [
+            {
+                "name": "1.0",
+                "images": [
+                    {"architecture": "amd64", "size": 10},
+                    {"architecture": "arm", "variant": "v7", "size": 5},
+                ],
+            }
+        ]
+        assert get_pull_size(tags, "1.0", "amd64") == 10
+        assert get_pull_size(tags, "1.0", "arm") == 5
+        assert get_pull_size(tags, "1.0", "arm64") is None
+        assert get_pull_size(tags, "2.0", "amd64") is None
+        assert get_pull_size(None, "1.0", "amd64") is None
+
+
+def compose_step(args, cwd, timeout, returncode=0):  # pylint: disable=unused-argument
+    """
+    Returns a ComposeStep as returned by run_compose
+    """
+    step = ComposeStep(["docker", "compose"] + list(args))
+    step.returncode = returncode
+    return step
+
 
 def request_dockerhub(status_code):
     """